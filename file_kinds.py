@@ -3,7 +3,8 @@
 #
 # Copyright 2010-2011 Tagged
 
-import os.path, re, tempfile
+from itertools import chain
+import os.path, re, tempfile, threading, weakref
 
 from jhm import BuildError, FileKind, FileKindNoIncl
 
@@ -25,6 +26,15 @@ def GetConfigSectionAsArgs(f, section):
   map(AddArg, f.YieldSection(section))
   return args
 
+def GetIncludeScanner(f):
+  """Get how the includes of the C or C++ source f are found: 'gcc' (gcc -M), 'jhm' (IncludeScanner), or 'depfile' (from
+  the depfile gcc writes while compiling it)."""
+  return f.GetConfig('include_scanner', result=f.env.GetConfig('include_scanner', default='gcc'))
+
+def ParseMakeDeps(text):
+  """Get the paths a make rule (as written by gcc -M or -MD) says its target depends on."""
+  return [os.path.normpath(path.strip()) for path in ' '.join(text.split(':', 1)[1].split('\\')).split()]
+
 def BuildGccEnv(cpp, item):
   cmd_name = ('g++' if cpp else 'gcc')
   args = [cmd_name] + GetConfigSectionAsArgs(item, cmd_name + '-args')
@@ -38,6 +48,164 @@ def BuildGccEnv(cpp, item):
 def BuildHaskellEnv(f):
   return ['ghc', '-outputdir', f.env.out_tree.GetAbsPath(HASKELL_OFFSET), '-i%s' % f.env.src_tree.GetAbsPath(HASKELL_OFFSET),'-i%s' % f.env.out_tree.GetAbsPath(HASKELL_OFFSET)] + GetConfigSectionAsArgs(f,'ghc-args')
 
+#An #include line. Groups are include_next, then either the delimiter and name of the header, or what is included if it is
+#computed (Ex. #include MACRO).
+INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include(_next)?[ \t]*(?:([<"])([^>"\n]*)[>"]|([^ \t\n].*))', re.M)
+
+#Headers gcc includes before every source without being asked, if they can be found (glibc's predefined macros).
+IMPLICIT_INCLUDES = [(False, False, 'stdc-predef.h')]
+
+#gcc flags which add directories to search for headers, by which list they add them to.
+SEARCH_DIR_FLAGS = {'-I': 'bracket', '-iquote': 'quote', '-isystem': 'system', '-idirafter': 'after'}
+#gcc flags which include a file before the source, as if by an #include "file" at its top.
+FORCED_INCLUDE_FLAGS = ['-include', '-imacros']
+#gcc flags which change where headers are searched for in ways the IncludeScanner doesn't follow.
+UNSUPPORTED_SEARCH_FLAGS = ['-I-', '-iprefix', '-iwithprefix', '-iwithprefixbefore', '-isysroot', '--sysroot']
+
+def ParseSearchPath(args):
+  """Get where gcc run with args looks for headers: (the directories searched for both kinds of #include in order, the
+  directories only searched for #include "...", and the (is_next, is_quoted, name) of the files it includes before the
+  source). Returns None if args change the search in a way that isn't followed."""
+  dir_dict = {'bracket': [], 'quote': [], 'system': [], 'after': []}
+  forced_list = []
+  i = 1
+  while i < len(args):
+    arg = args[i]
+    i += 1
+    if any(arg == flag or arg.startswith(flag + '=') for flag in UNSUPPORTED_SEARCH_FLAGS):
+      return None
+    for flag in chain(sorted(SEARCH_DIR_FLAGS, key=len, reverse=True), FORCED_INCLUDE_FLAGS):
+      if not arg.startswith(flag):
+        continue
+      value = arg[len(flag):]
+      if not value:
+        if i == len(args):
+          return None
+        value = args[i]
+        i += 1
+      if value.startswith('='):
+        #Relative to the sysroot.
+        return None
+      if flag in SEARCH_DIR_FLAGS:
+        dir_dict[SEARCH_DIR_FLAGS[flag]].append(os.path.abspath(value))
+      else:
+        forced_list.append((False, True, value))
+      break
+
+  #gcc only searches each directory once, where it first comes in the search.
+  search_list = []
+  for d in chain(dir_dict['bracket'], dir_dict['system'], dir_dict['after']):
+    if d not in search_list:
+      search_list.append(d)
+  return search_list, [d for d in dir_dict['quote'] if d not in search_list], forced_list
+
+class IncludeScanner(object):
+  """Finds what C and C++ sources include by reading their #include lines, rather than running the preprocessor.
+
+  Headers are searched for the way gcc run with the same arguments would (-I, -iquote, -isystem, -idirafter, -include
+  and -imacros are followed, and each tree is a -I), but only headers in a tree are Files JHM can build from. Every
+  #include is followed, whatever #if it is inside of, and headers which can't be found (unless they can be built) are
+  skipped, so this may find more than the preprocessor would, but not less. The includes of each header are read once
+  (and again only if it changes), so headers included everywhere are only read once."""
+
+  def __init__(self):
+    self.__include_dict = {}  #Path -> (size, mtime, inode, [(is_next, is_quoted, name)], or None if it has computed includes)
+
+  def GetInclSet(self, f, args):
+    """Get the set of Files f includes, directly or not, when compiled by gcc with args. None if something it includes
+    is computed, or args search for headers in a way which isn't followed, since only the preprocessor can work those
+    out."""
+    env = f.env
+    search_path = ParseSearchPath(args)
+    if search_path is None:
+      return None
+    search_list, quote_list, forced_list = search_path
+    tree_list = list(env.YieldEachTree())
+    incl_set = set()
+    path_set = set([f.abs_path])
+    to_check = [(f.abs_path, None)]
+    while to_check:
+      path, dir_index = to_check.pop()
+      include_list = self.__GetIncludes(env, path)
+      if include_list is None:
+        return None
+      entry_list = [(incl, os.path.dirname(path)) for incl in include_list]
+      if path == f.abs_path:
+        #Files gcc is told to include are looked for in its working directory first, rather than next to the source.
+        entry_list = ([(incl, os.path.dirname(path)) for incl in IMPLICIT_INCLUDES]
+                      + [(incl, os.getcwd()) for incl in forced_list] + entry_list)
+      for (is_next, is_quoted, name), incl_dir in entry_list:
+        incl_path, incl_dir_index = self.__Find(env, tree_list, search_list, quote_list, incl_dir, dir_index, is_next,
+                                                is_quoted, name)
+        if incl_path is None:
+          #It may be a header which hasn't been generated yet.
+          if not os.path.isabs(name):
+            incl = env.GetFileFromPath(os.path.normpath(name))
+            if incl.is_available:
+              incl_set.add(incl)
+          continue
+        if incl_path not in path_set:
+          path_set.add(incl_path)
+          to_check.append((incl_path, incl_dir_index))
+          incl_set.add(env.GetFileFromPath(incl_path))
+    return frozenset(incl_set)
+
+  def __GetIncludes(self, env, path):
+    """Get the (is_next, is_quoted, name) of each #include in the file at path, or None if some are computed."""
+    st = env.stat_cache.Stat(path)
+    if st is None:
+      return []
+    stat_key = (st.st_size, st.st_mtime, st.st_ino)
+    entry = self.__include_dict.get(path)
+    if entry is not None and entry[:3] == stat_key:
+      return entry[3]
+
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+    except IOError:
+      return []
+    include_list = []
+    for m in INCLUDE_RE.finditer(data):
+      if m.group(4) is not None:
+        include_list = None
+        break
+      include_list.append((m.group(1) is not None, m.group(2) == '"', m.group(3).strip()))
+    self.__include_dict[path] = stat_key + (include_list,)
+    return include_list
+
+  def __Find(self, env, tree_list, search_list, quote_list, incl_dir, dir_index, is_next, is_quoted, name):
+    """Find the header an #include names, the way the preprocessor would. incl_dir is the directory of the including
+    file, and dir_index the index in search_list of the directory it was found through (None if it wasn't).
+
+    Returns the absolute path of the header and the index of the directory it was found through, (None, None) if it
+    isn't in any tree."""
+    if os.path.isabs(name):
+      candidate_list = [(name, None)]
+    else:
+      ##include_next searches the directories after the one the including file was found through.
+      start = dir_index + 1 if is_next and dir_index is not None else 0
+      candidate_list = [(os.path.join(search_list[i], name), i) for i in range(start, len(search_list))]
+      if is_quoted and not is_next:
+        candidate_list[:0] = [(os.path.join(d, name), None) for d in [incl_dir] + quote_list]
+    for candidate, index in candidate_list:
+      candidate = os.path.normpath(candidate)
+      if env.stat_cache.Exists(candidate) and any(t.ContainsAbs(candidate) for t in tree_list):
+        return candidate, index
+    return None, None
+
+#The IncludeScanner of each Env. What was read from headers isn't kept past the Env it was read for.
+env_include_scanners = weakref.WeakKeyDictionary()
+env_include_scanners_lock = threading.Lock()
+
+def GetEnvIncludeScanner(env):
+  """Get the IncludeScanner of env, making it if it doesn't have one yet."""
+  with env_include_scanners_lock:
+    scanner = env_include_scanners.get(env)
+    if scanner is None:
+      scanner = env_include_scanners[env] = IncludeScanner()
+    return scanner
+
 class CSource(FileKind):
   def __init__(self, is_cpp, ext):
     FileKind.__init__(self, 'C++' if is_cpp else 'C' + ' source', ext)
@@ -45,13 +213,23 @@ class CSource(FileKind):
     self.__ext = ext
 
   def GetInclSet(self, f):
+    #The preprocessor is always right, but costs a process and a full preprocess of every source.
+    scanner = GetIncludeScanner(f)
+    gcc_args = BuildGccEnv(self.__is_cpp, f)
+    if scanner == 'jhm':
+      incl_set = GetEnvIncludeScanner(f.env).GetInclSet(f, gcc_args)
+      if incl_set is not None:
+        return incl_set
+    #What's included is only found out by compiling. CompileC gives it to the object file.
+    elif scanner == 'depfile':
+      return frozenset()
+
     def YieldEach():
-      args = BuildGccEnv(self.__is_cpp, f)
-      args += ['-M', '-MG', f.abs_path]
+      args = gcc_args + ['-M', '-MG', f.abs_path]
 
       (stdout, stderr) = f.env.RunCmd(args,True)
-      for path in ' '.join(stdout.split(':', 1)[1].split('\\')).split():
-        yield f.env.GetFileFromPath(os.path.normpath(path.strip()))
+      for path in ParseMakeDeps(stdout):
+        yield f.env.GetFileFromPath(path)
     return frozenset(YieldEach())
 
 class Executable(FileKind):
@@ -61,22 +239,75 @@ class Executable(FileKind):
   def GetInclSet(self, f):
     return frozenset()
 
+#Comments (but not pragmas) in Haskell source, which can hide imports or look like them.
+HASKELL_COMMENT_RE = re.compile(r'\{-(?!#).*?-\}|--.*?$', re.S | re.M)
+HASKELL_MODULE_RE = re.compile(r'^module\s+([A-Z][\w.\']*)', re.M)
+#An import. Groups are the package it is from (if given), and the module.
+HASKELL_IMPORT_RE = re.compile(r'^import\s+(?:\{-#\s*SOURCE\s*#-\}\s+)?(?:safe\s+)?(?:qualified\s+)?(?:"([^"]+)"\s+)?([A-Z][\w.\']*)', re.M)
+#Signs a module uses the C preprocessor, which can change what it imports.
+HASKELL_CPP_RE = re.compile(r'^#\s*[a-z]|\{-#\s*LANGUAGE\b[^#]*\bCPP\b', re.M)
+
+def ScanHaskellImports(path):
+  """Read what the Haskell module at path imports, without running ghc. Returns (whether it is Main, the set of modules
+  it imports, the set of packages it names in imports), or None if the module uses CPP, which only ghc can follow."""
+  with open(path) as f:
+    data = f.read()
+  if HASKELL_CPP_RE.search(data):
+    return None
+  data = HASKELL_COMMENT_RE.sub('', data)
+  m = HASKELL_MODULE_RE.search(data)
+  is_main = m is None or m.group(1) == 'Main'
+  hs_deps = set()
+  lib_deps = set()
+  for m in HASKELL_IMPORT_RE.finditer(data):
+    hs_deps.add(m.group(2))
+    if m.group(1):
+      lib_deps.add(m.group(1))
+  return is_main, hs_deps, lib_deps
+
 class Haskell(FileKind):
   def __init__(self):
     FileKind.__init__(self, 'haskell source', 'hs')
 
   def GetInclSet(self, f):
+    #ghc -M reads every module under HASKELL_OFFSET for each module it's run on. Reading just the imports is much faster.
+    imports = None
+    if f.GetConfig('haskell_scanner', result=f.env.GetConfig('haskell_scanner', default='ghc')) == 'jhm':
+      imports = ScanHaskellImports(f.abs_path)
+    if imports is None:
+      imports = self.__RunGhcM(f)
+    is_main, hs_deps, lib_deps = imports
+
+    if is_main:
+      f.jhm_cache_file.Set('haskell', 'main', 'true')
+    for lib in lib_deps:
+      f.jhm_cache_file.Set('haskell-lib-deps', lib)
+
     incl_set = set()
+    #Convert dep to filename, check if it's in Database.Stig
+    for dep in hs_deps:
+      if dep.find('Database.Stig') == 0:
+        branch, base = '/'.join(dep.split('.')).rsplit('/',1)
+        incl_set.add(f.GetRelatedFileAndTree(branch=os.path.join(HASKELL_OFFSET, branch),base=base, ext_list=['hs']))
+        incl_set.add(f.GetRelatedFileAndTree(branch=os.path.join(HASKELL_OFFSET, branch),base=base, ext_list=['hi']))
+      else:
+        f.jhm_cache_file.Set('haskell-deps', dep)
+    return frozenset(incl_set)
+
+  def __RunGhcM(self, f):
+    """Find what f imports with ghc -M. Returns the same as ScanHaskellImports."""
     handle, tmp_fname = tempfile.mkstemp()
     os.close(handle)
     args = BuildHaskellEnv(f) + ['-M', '-v2', f.abs_path,'-dep-makefile',tmp_fname]
     (stdout, stderr) = f.env.RunCmd(args, True)
     os.remove(tmp_fname)
+    is_main = False
     hs_deps = set()
+    lib_deps = set()
     for m in re.finditer(r'ms_mod = (.*)', stderr):
       dep = m.group(1)
       if dep.startswith('main:Main'):
-        f.jhm_cache_file.Set('haskell', 'main', 'true')
+        is_main = True
 
     for m in re.finditer(r'import ([a-zA-Z0-9._\-]+)', stderr):
       dep = m.group(1)
@@ -87,16 +318,8 @@ class Haskell(FileKind):
       hs_deps.add(m.group(1))
     for m in re.finditer(r'import "([a-zA-Z0-9_\-]+)" ([a-zA-Z0-9._\-]+)', stderr):
       hs_deps.add(m.group(2))
-      f.jhm_cache_file.Set('haskell-lib-deps', m.group(1))
-    #Convert dep to filename, check if it's in Database.Stig
-    for dep in hs_deps:
-      if dep.find('Database.Stig') == 0:
-        branch, base = '/'.join(dep.split('.')).rsplit('/',1)
-        incl_set.add(f.GetRelatedFileAndTree(branch=os.path.join(HASKELL_OFFSET, branch),base=base, ext_list=['hs']))
-        incl_set.add(f.GetRelatedFileAndTree(branch=os.path.join(HASKELL_OFFSET, branch),base=base, ext_list=['hi']))
-      else:
-        f.jhm_cache_file.Set('haskell-deps', dep)
-    return frozenset(incl_set)
+      lib_deps.add(m.group(1))
+    return is_main, hs_deps, lib_deps
 
 class Header(FileKind):
   def __init__(self):
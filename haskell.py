@@ -3,21 +3,97 @@
 #
 # Copyright 2010-2011 Tagged
 
-import os.path, threading
+import glob, json, os, os.path, re, threading
 from itertools import chain
 
-from jhm import RunCmd
+from jhm import BuildError, EnsurePathExists, RunCmd, ToStr
 
+#Where the parsed package database is kept between runs.
+DEFAULT_CACHE_FILENAME = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'jhm',
+                                      'ghc-pkg.json')
 
 class Deps(object):
-  def __init__(self):
+  """The packages in the ghc package database, and what to link for the modules they expose.
+
+  Parsing 'ghc-pkg dump' is slow, so what it gives is saved in cache_filename, and only read again from ghc-pkg when
+  the ghc version or the stat of one of the package databases changes."""
+
+  def __init__(self, cache_filename=DEFAULT_CACHE_FILENAME):
     #Lazy loaded to keep from doing work when not necessary.
+    self.__cache_filename = cache_filename
     self.__module_dict = None
     self.__modules_by_id = {}
+    self.__modules_by_import = {}  #Exposed module name -> list of package dicts exposing it
+    self.__args_by_id = {}         #Package id -> tuple of what to link for it (Including what it depends on)
+    self.__ghc_version = None
     self.__module_dict_lock = threading.Lock()
 
   def __BuildDb(self):
     self.__module_dict = {}
+    stamp = self.__GetDbStamp()
+    package_list = self.__ReadCache(stamp) if stamp is not None else None
+    if package_list is None:
+      package_list = self.__DumpDb()
+      if stamp is not None:
+        self.__WriteCache(stamp, package_list)
+
+    for submodule_dict in package_list:
+      self.__module_dict[submodule_dict['name_str']] = submodule_dict
+      self.__modules_by_id[submodule_dict['id_str']] = submodule_dict
+    for submodule_dict in self.__module_dict.values():
+      for name in submodule_dict['exposed-modules']:
+        self.__modules_by_import.setdefault(name, []).append(submodule_dict)
+
+  def __GetDbStamp(self):
+    """Get what identifies the current package database (ghc version, package db paths and their stats), or None if
+    ghc can't say where they are."""
+    try:
+      (stdout, stderr) = RunCmd(['ghc', '--info'], True, False)
+    except BuildError:
+      return None
+    info = dict(re.findall(r'\("([^"]*)","([^"]*)"\)', stdout))
+    self.__ghc_version = info.get('Project version')
+    if self.__ghc_version is None or 'Global Package DB' not in info:
+      return None
+
+    db_list = [info['Global Package DB']]
+    db_list += glob.glob(os.path.expanduser('~/.ghc/*-%s/package.conf*' % self.__ghc_version))
+    db_list += [path for path in os.environ.get('GHC_PACKAGE_PATH', '').split(':') if path]
+    stamp_list = []
+    #ghc-pkg rewrites package.cache in a package.conf.d whenever it changes one, which updates the dir as well.
+    for path in chain.from_iterable((path, os.path.join(path, 'package.cache')) for path in db_list):
+      try:
+        st = os.stat(path)
+        stamp_list.append([path, repr(st.st_mtime), st.st_size])
+      except OSError:
+        stamp_list.append([path, None, None])
+    return [self.__ghc_version, stamp_list]
+
+  def __ReadCache(self, stamp):
+    """Get the packages saved in the cache file, or None if they were saved for a different stamp."""
+    try:
+      with open(self.__cache_filename, 'r') as f:
+        cache = ToStr(json.load(f))
+    except (IOError, ValueError):
+      return None
+    if cache.get('stamp') != stamp:
+      return None
+    return cache.get('packages')
+
+  def __WriteCache(self, stamp, package_list):
+    try:
+      EnsurePathExists(os.path.dirname(self.__cache_filename))
+      tmp_filename = '%s.%d.tmp' % (self.__cache_filename, os.getpid())
+      with open(tmp_filename, 'w') as f:
+        json.dump({'stamp': stamp, 'packages': package_list}, f)
+      os.rename(tmp_filename, self.__cache_filename)
+    except (IOError, OSError):
+      #Not being able to save it only means it'll be read from ghc-pkg again next time.
+      pass
+
+  def __DumpDb(self):
+    """Get the exposed packages from ghc-pkg dump."""
+    package_list = []
     #TODO: Print all commands flag doesn't reach this...
     (stdout, stderr) = RunCmd(['ghc-pkg','dump'], True, False)
     for module in stdout.split('---'):
@@ -50,10 +126,15 @@ class Deps(object):
       ToArray('extra-libraries')
       if submodule_dict.get('exposed_str','True').strip() == 'False':
         continue
-      self.__module_dict[submodule_dict['name_str']] = submodule_dict
-      self.__modules_by_id[submodule_dict['id_str']] = submodule_dict
+      package_list.append(submodule_dict)
+    return package_list
 
   def __ExtractArgs(self, mod_dict):
+    #The same packages are depended on by most others, so what each needs is only worked out once.
+    link_tuple = self.__args_by_id.get(mod_dict['id_str'])
+    if link_tuple is not None:
+      return link_tuple
+
     #TODO: This probably is slightly oversimplified
     link_list = [(mod_dict['library-dirs_str'], mod_dict['hs-libraries_str'])]
     for l in mod_dict['extra-libraries']:
@@ -62,17 +143,20 @@ class Deps(object):
 
     for dep in  mod_dict['depends']:
       link_list += self.GetLinkArgsById(dep)
-    return link_list
+    link_tuple = self.__args_by_id[mod_dict['id_str']] = tuple(link_list)
+    return link_tuple
 
   def GetLinkArgsByImportName(self, import_list):
-    #TODO: This is a bad way to do this search. Should really index, but are lazy for now.
-    if import_list is None:
+    #Nothing imported means nothing to link, so don't load the package database for it.
+    if not import_list:
       return list()
     link_list = list()
-    for k, v in self.module_dict.items():
-      for f in import_list:
-        assert f == f.strip()
-        if f in v['exposed-modules']:
+    used_set = set()
+    for f in import_list:
+      assert f == f.strip()
+      for v in self.modules_by_import.get(f, ()):
+        if v['id_str'] not in used_set:
+          used_set.add(v['id_str'])
           link_list += self.__ExtractArgs(v)
     return link_list
 
@@ -107,8 +191,7 @@ class Deps(object):
       if l[0] is None:
         args.append('-l%s' % l[1])
       else:
-        ghc_ver = RunCmd(['ghc', '--numeric-version'], True, False)[0].strip()
-        args += ['-L%s' % l[0], '-l%s-ghc%s' % (l[1],ghc_ver)]
+        args += ['-L%s' % l[0], '-l%s-ghc%s' % (l[1],self.ghc_version)]
     return args
 
   def GetLinkArgsById(self, id_):
@@ -130,3 +213,16 @@ class Deps(object):
     #Ensure initialized
     assert(self.module_dict)
     return self.__modules_by_id
+
+  @property
+  def modules_by_import(self):
+    #Ensure initialized
+    assert(self.module_dict)
+    return self.__modules_by_import
+
+  @property
+  def ghc_version(self):
+    with self.__module_dict_lock:
+      if self.__ghc_version is None:
+        self.__ghc_version = RunCmd(['ghc', '--numeric-version'], True, False)[0].strip()
+      return self.__ghc_version
@@ -182,15 +182,49 @@ are specified in order of precedence.
 Once we've determined a file is available, we simply call its build function.  This will cause JHM to traverse up and
 down the dependency/requires tree, expanding it as necessary, at all times working on something relevant for the file
 which needs to be built. JHM will queue up things that need to be built/finished, and will have an arbitrary number of
-workers (Defaults to the number of cores in your machine), working on whittling the queue down to nothing. When the
+workers (Defaults to the number of cores in your machine), working on whittling the queue down to nothing. Items on
+the longest chain of jobs (going by how long each job took in previous builds) are worked on first. The commands jobs
+run are handed to a command executor which has its own number of process slots (--num-procs), so the workers only ever
+spend their time on the dependency graph. When the
 queue is empty, it means that everything requested was built. If there is a build error at some point in the process,
-JHM will print all related output and wait for all the other workers to exit.
+JHM will print all related output and wait for all the other workers to exit. With --keep-going, JHM instead keeps
+building everything which doesn't need what failed, and lists all the failures at the end.
 
-JHM stores a cache file for each file it builds.  The cache file contains extra arguments/configuration for jobs
+JHM stores a cache for each file it builds. By default the caches of all files are kept together in one log in the
+output tree, which is read once at startup and appended to in batches (--cache-store=file keeps a '.jhm-cache' file
+next to each output instead). The cache contains extra arguments/configuration for jobs
 which use the file, as well as the requires for the file (remember, files have requires, jobs have dependencies).
 If JHM determines that this information is up to date, then it will skip trying to build the given output file,
 asserting that it is already built, and load the cached information, saving JHM from having to explore more of the
-dependency graph and run the job/jobs needed to build the file.
+dependency graph and run the job/jobs needed to build the file. Normally a file is out of date when something it
+requires is newer than its cache file. In digest mode (--digest, or digest=true in the config) the cache file instead
+records a digest of the contents of everything the file requires, and the file is only out of date when one of those
+has actually changed. Digests are kept in the output tree, and a file is only hashed again if its size, mtime, or inode
+changes.
+The cache of a generated file also records a signature of the commands its producer ran. Before such a file is taken
+from its cache, the producer works out the commands it would run now, and if they differ (Ex. a flag was changed in a
+.jhm file) the file is rebuilt, even though nothing it requires changed.
+When a job makes an output exactly the same as it was before, the output keeps its old mtime (--no-restat turns this
+off), and files generated from something are only out of date if what was generated changed, not what it was generated
+from. So regenerating a header with the same contents (Ex. after a comment in its .nyc changed) rebuilds nothing else.
+
+Outputs can also be shared between builds through artifact caches: a directory (--artifact-cache) which any number of
+out trees can share, and a server (--remote-cache, see jhm_cache_server) which many machines can share. Jobs are looked
+up in them by a digest of their commands and the contents of everything they read, and only run if neither has their
+outputs.
+
+After a successful build, a snapshot of what each target needed is saved in the output tree ('.jhm-graph'). On the
+next build, a target is skipped entirely if a stat of everything in its snapshot (and the config) shows nothing has
+changed, so a build with nothing to do doesn't even build the graph (--no-graph-snapshot turns this off).
+
+With --watch, jhm keeps the environment after building and waits for changes with inotify. Only the files which
+changed, and everything that was made from them, are checked again, so a rebuild costs only what actually changed.
+Changes to config, or files being added or removed, start over with a fresh environment.
+
+Tools which run jhm over and over can instead start jhm_server in the project. It keeps environments (one per config,
+arch and system) loaded between builds, watching them for changes the same way --watch does. While it is running, jhm
+and jhm_tree hand their arguments to it over a unix socket ('.jhm-server' in the project root) and print what it sends
+back, so they don't pay for starting up and loading the graph each time. Without a server, they build as usual.
 
 CONFIGURATION
 JHM can be configured at the System, User, Project, and File level. System configuration should include standard
@@ -212,6 +246,26 @@ configuration which the configuration inherits from by specifying 'parent=filena
 are a number of jhm options which can be set in jhm config files, and a number of job kinds take standard arguments. To
 read them look at the __init__ function for the Env class.
 
+Jobs can be limited by named resources. The 'resources' section says how much of each resource there is (Ex. 'link=2',
+'memory=16G'), job kinds say how much of each they use while running, and the 'job-resources' section can override that
+by job kind name (Ex. 'link=link,memory=4G'). A job is only run if what it needs fits in what isn't already in use.
+
+C and C++ sources are scanned for what they include by running 'gcc -M'. With include_scanner=jhm (in the config, or the
+.jhm file of a source), their #include lines are read by JHM instead, and what each header includes is only read once.
+Headers are searched for through the trees and the -I, -iquote, -isystem, -idirafter, -include and -imacros flags in
+gcc-args (or g++-args). Sources which include something computed (Ex. '#include MACRO'), or whose flags change the search
+in other ways (Ex. --sysroot), are still scanned by gcc. With include_scanner=depfile,
+sources aren't scanned at all: the compile writes a depfile of what it included, which becomes what the object file
+requires. Headers which have to be generated first, or whose .jhm files give flags to what includes them, aren't known
+about until after the first compile, so sources which use them should be scanned. Such compiles also skip the artifact
+caches, since what they read isn't known up front.
+
+Haskell sources are likewise scanned for what they import with 'ghc -M', which reads every module it can find each time.
+With haskell_scanner=jhm, the import lines of just the source are read by JHM instead. Sources which use CPP are still
+scanned by ghc. Each Haskell module is compiled on its own with -fforce-recomp. With haskell_compile=make, modules which are
+ready to compile at the same time are compiled together by one 'ghc --make -j', which also skips modules none of whose
+imports' interfaces changed. Main modules are still compiled on their own.
+
 FileKinds and JobKinds are specializations/inherit from jhm.{JobKind, FileKind}, and as such should be written in a
 python file. They are loaded using the same order as jhm config files, except they begin with 'file_kinds' and
 'job_kinds' as prefixes, instead of the configuration name or 'jhm'. Just inheriting from the class in an imported
@@ -221,7 +275,6 @@ job_kinds within the loaded file.
 TODO (Short run)
 Make it so some configs are not buildable again (is_buildable=no/false/off), and the configs can be mixed and matched.
     Ex. A specific config could enable/disable some feature.
-Get rid fo the spinlock that happens when one item is in the queue being processed and all others are waiting on it.
 
 """
 
@@ -233,34 +286,190 @@ Get rid fo the spinlock that happens when one item is in the queue being process
     for the buildable to be run, as well as a list of things which depend on the buildable.
 """
 
-import argparse, heapq, copy, imp, multiprocessing, subprocess, threading, os, os.path, platform, re, signal, sys, threading, traceback
+import argparse, atexit, collections, ctypes, ctypes.util, heapq, copy, errno, fcntl, filecmp, hashlib, httplib, imp, itertools, json, multiprocessing, subprocess, threading, os, os.path, platform, Queue, re, select, shutil, signal, struct, sys, threading, time, traceback, urllib2
 
 from itertools import chain, ifilter
 
 class BuildError(Exception):
   """An error in attempting to build"""
 
-def RunCmd(args, return_output=False, print_command=False):
-  """Run the given build command with the given arguments."""
-  if print_command:
-    print ' '.join(args)
-
+def SpawnCmd(args, stdin=subprocess.PIPE):
+  """Start the given command with its stdout and stderr piped back to us."""
   try:
-    opened = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
   except OSError as e:
     if e.errno == 2:
       raise BuildError('Program "%s" is not in PATH' % args[0])
     raise
-  retval = opened.communicate()
 
-  if opened.returncode != 0:
+def CheckCmdResult(args, returncode, output, print_command=False):
+  """Raise a BuildError if the given command, which exited with returncode and printed output (stdout, stderr), failed."""
+  if returncode != 0:
     if not print_command:
       print ' '.join(args)
-    raise BuildError("ERROR RUNNING COMMAND: %s, Returncode %s\nSTDOUT:\n%s\nSTDERR:\n%s" % (args, opened.returncode, retval[0],retval[1]))
+    raise BuildError("ERROR RUNNING COMMAND: %s, Returncode %s\nSTDOUT:\n%s\nSTDERR:\n%s" % (args, returncode, output[0], output[1]))
+
+def RunCmd(args, return_output=False, print_command=False):
+  """Run the given build command with the given arguments."""
+  if print_command:
+    print ' '.join(args)
+
+  opened = SpawnCmd(args)
+  retval = opened.communicate()
+  CheckCmdResult(args, opened.returncode, retval, print_command)
 
   if return_output:
     return retval
 
+def SetCloseOnExec(fd):
+  """Make sure the given file descriptor isn't inherited by child processes."""
+  fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class RunningCommand(object):
+  """A command started by a CommandExecutor, and everything it has printed so far."""
+
+  def __init__(self, args, callback, process):
+    self.args = args
+    self.callback = callback
+    self.process = process
+    self.start = time.time()
+    self.stdout_fd = process.stdout.fileno()
+    self.stderr_fd = process.stderr.fileno()
+    self.output_dict = {self.stdout_fd: [], self.stderr_fd: []}
+    self.open_fd_set = set(self.output_dict.keys())
+
+  @property
+  def output(self):
+    return (''.join(self.output_dict[self.stdout_fd]), ''.join(self.output_dict[self.stderr_fd]))
+
+class CommandExecutor(object):
+  """Runs commands in child processes, with at most num_slots of them running at once.
+
+  The output of every running command is collected by a single thread using poll, so whoever submits a command doesn't
+  need to tie up a thread in communicate() while it runs. Commands wait for a free slot in the order they're submitted.
+  """
+
+  #How often (in milliseconds) to check on commands which have closed their output but haven't exited yet.
+  REAP_INTERVAL = 10
+
+  def __init__(self, num_slots):
+    self.__num_slots = num_slots
+
+    self.__waiting = collections.deque()  #(args, callback) of commands waiting for a free slot.
+    self.__num_running = 0                #Number of slots in use.
+    self.__lock = threading.Lock()        #The lock for all the above
+    self.__idle = threading.Condition(self.__lock)  #Notified whenever a slot is freed.
+
+    #Only touched by the executor thread.
+    self.__fd_dict = {}           #Output fd -> RunningCommand
+    self.__exiting_set = set()    #Commands which have closed all their output, but haven't been reaped.
+
+    self.__poll = select.poll()
+    self.__wake_read, self.__wake_write = os.pipe()
+    for fd in [self.__wake_read, self.__wake_write]:
+      SetCloseOnExec(fd)
+    self.__poll.register(self.__wake_read, select.POLLIN)
+    self.__stdin = open(os.devnull, 'r')
+    SetCloseOnExec(self.__stdin.fileno())
+
+    self.__thread = None
+
+  def Submit(self, args, callback):
+    """Queue the command args to be run.
+
+    Once the command exits, callback(args, returncode, output, elapsed, exc_info) is called from the executor thread with
+    output being (stdout, stderr) and elapsed the number of seconds it ran for. If the command couldn't be started,
+    exc_info is the exception which was raised trying.
+    """
+    with self.__lock:
+      self.__waiting.append((args, callback))
+      if self.__thread is None:
+        self.__thread = threading.Thread(name='CommandExecutor', target=self.__Loop)
+        self.__thread.daemon = True
+        self.__thread.start()
+    os.write(self.__wake_write, 'x')
+
+  def Run(self, args):
+    """Run the command args, waiting for it to finish. Returns (returncode, (stdout, stderr))."""
+    finished = threading.Event()
+    result = []
+    def Finished(args, returncode, output, elapsed, exc_info):
+      result.append((returncode, output, exc_info))
+      finished.set()
+
+    self.Submit(args, Finished)
+    finished.wait()
+    returncode, output, exc_info = result[0]
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return returncode, output
+
+  def Stop(self):
+    """Drop all the commands which haven't been started, and wait for the running ones to exit."""
+    with self.__lock:
+      self.__waiting.clear()
+      while self.__num_running > 0:
+        self.__idle.wait()
+
+  def __Loop(self):
+    """Start commands as slots free up, and gather their output until they exit."""
+    while True:
+      self.__StartWaiting()
+
+      for fd, event in self.__poll.poll(CommandExecutor.REAP_INTERVAL if self.__exiting_set else None):
+        if fd == self.__wake_read:
+          os.read(fd, 4096)
+          continue
+
+        command = self.__fd_dict[fd]
+        data = os.read(fd, 65536)
+        if data:
+          command.output_dict[fd].append(data)
+        else:
+          self.__poll.unregister(fd)
+          del self.__fd_dict[fd]
+          command.open_fd_set.remove(fd)
+          if not command.open_fd_set:
+            self.__exiting_set.add(command)
+
+      for command in list(self.__exiting_set):
+        if command.process.poll() is not None:
+          self.__exiting_set.remove(command)
+          command.process.stdout.close()
+          command.process.stderr.close()
+          self.__Done(command.callback, command.args, command.process.returncode, command.output, time.time() - command.start)
+
+  def __StartWaiting(self):
+    """Start as many waiting commands as there are free slots for."""
+    while True:
+      with self.__lock:
+        if not self.__waiting or self.__num_running >= self.__num_slots:
+          return
+        args, callback = self.__waiting.popleft()
+        self.__num_running += 1
+
+      try:
+        process = SpawnCmd(args, self.__stdin)
+      except Exception:
+        self.__Done(callback, args, None, None, 0, sys.exc_info())
+        continue
+
+      command = RunningCommand(args, callback, process)
+      for fd in command.open_fd_set:
+        SetCloseOnExec(fd)
+        self.__fd_dict[fd] = command
+        self.__poll.register(fd, select.POLLIN)
+
+  def __Done(self, callback, args, returncode, output, elapsed, exc_info=None):
+    """Free up the slot the command was using, and tell whoever submitted it how it went."""
+    try:
+      callback(args, returncode, output, elapsed, exc_info)
+    except Exception:
+      traceback.print_exc()
+    with self.__lock:
+      self.__num_running -= 1
+      self.__idle.notify_all()
+
 #Things that should be in the python stdlib..
 def EnsurePathExists(path):
   """Makes the path if possible. If the path already exists, do nothing. Threadsafe (makedirs isn't)."""
@@ -271,22 +480,604 @@ def EnsurePathExists(path):
     if e.errno != 17:
       raise
 
+def ParseAmount(amount):
+  """Parse an amount of a resource, such as '2', '0.5' or '4G' (K, M, G, and T are powers of 1024). No amount means 1."""
+  if amount is None:
+    return 1
+  amount = amount.strip()
+  multiplier = 1
+  if amount and amount[-1].upper() in 'KMGT':
+    multiplier = 1024 ** ('KMGT'.index(amount[-1].upper()) + 1)
+    amount = amount[:-1]
+  try:
+    return float(amount) * multiplier
+  except ValueError:
+    raise BuildError('Invalid resource amount "%s"' % amount)
+
+def ParseBool(value):
+  """Parse a yes/no config value: yes, true or on, against no, false or off. A key given without a value is on."""
+  if value is None:
+    return True
+  if value.strip().lower() in ['yes', 'true', 'on']:
+    return True
+  if value.strip().lower() in ['no', 'false', 'off']:
+    return False
+  raise BuildError('Invalid yes/no value "%s". It must be yes/true/on or no/false/off' % value)
+
+def ParseResources(value):
+  """Parse a comma separated list of resources with optional amounts (Ex. 'link,memory=4G') into a dict."""
+  resource_dict = {}
+  for resource in (value or '').split(','):
+    if resource.strip() == '':
+      continue
+    args = resource.split('=', 1)
+    resource_dict[args[0].strip()] = ParseAmount(args[1] if len(args) > 1 else None)
+  return resource_dict
+
 def GetTimestamp(path):
-  return os.path.getmtime(path) if os.path.exists(path) else 0
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return 0
+
+class StatCache(object):
+  """The results of os.stat and os.listdir, shared by all the threads of a build so each is only done once per path.
+
+  Whether a file exists is answered from the listing of its directory, so probing lots of names in the same directory
+  costs a single listdir. Paths in volatile directories (such as the output tree, which jobs write to) are never cached,
+  but are still counted.
+  """
+
+  def __init__(self, volatile_list=[]):
+    self.__volatile_list = list(volatile_list)
+    self.__stat_dict = {}     #Path -> os.stat result, or None if it doesn't exist.
+    self.__listdir_dict = {}  #Path -> frozenset of names in the directory, or None if it can't be listed.
+    self.__lock = threading.Lock()
+
+    #Statistics, for verbose output.
+    self.__num_stats = 0
+    self.__num_listdirs = 0
+    self.__num_hits = 0
+
+  def Exists(self, path):
+    """Whether anything exists at the given path."""
+    if self.__IsVolatile(path):
+      return self.Stat(path) is not None
+    dirname, name = os.path.split(os.path.normpath(path))
+    listing = self.ListDir(dirname)
+    if listing is None:
+      return self.Stat(path) is not None
+    return name in listing
+
+  def GetTimestamp(self, path):
+    """Get the mtime of the given path, 0 if it doesn't exist."""
+    st = self.Stat(path)
+    return st.st_mtime if st else 0
+
+  def ListDir(self, path):
+    """Get the frozenset of names in the given directory. Returns None if the directory couldn't be listed."""
+    cache = not self.__IsVolatile(path)
+    if cache:
+      with self.__lock:
+        if path in self.__listdir_dict:
+          self.__num_hits += 1
+          return self.__listdir_dict[path]
+
+    try:
+      listing = frozenset(os.listdir(path))
+    except OSError as e:
+      #If the directory isn't there we know everything in it isn't. Otherwise we don't know anything.
+      listing = frozenset() if e.errno in [errno.ENOENT, errno.ENOTDIR] else None
+
+    with self.__lock:
+      self.__num_listdirs += 1
+      if cache:
+        self.__listdir_dict[path] = listing
+    return listing
+
+  def Stat(self, path):
+    """Get the os.stat result for the given path, or None if it doesn't exist."""
+    cache = not self.__IsVolatile(path)
+    if cache:
+      with self.__lock:
+        if path in self.__stat_dict:
+          self.__num_hits += 1
+          return self.__stat_dict[path]
+
+    try:
+      st = os.stat(path)
+    except OSError:
+      st = None
+
+    with self.__lock:
+      self.__num_stats += 1
+      if cache:
+        self.__stat_dict[path] = st
+    return st
+
+  def Forget(self, path_set):
+    """Forget what is known about the given paths (and the listings of their directories), since they've changed."""
+    with self.__lock:
+      for path in path_set:
+        self.__stat_dict.pop(path, None)
+        self.__listdir_dict.pop(os.path.dirname(path), None)
+
+  def __IsVolatile(self, path):
+    for volatile in self.__volatile_list:
+      if path.startswith(volatile) or path == volatile[:-1]:
+        return True
+    return False
+
+  def __str__(self):
+    return '%s stats, %s listdirs, %s cache hits' % (self.__num_stats, self.__num_listdirs, self.__num_hits)
+
+def HashFile(path):
+  """Get the hex digest of the contents of the file at path."""
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(65536), ''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def GetCommandSignature(command_list):
+  """Get the hex digest of the argument vectors of the given (args, print_command) commands.
+
+  The arguments are hashed in order, since their order can change what a command does (Ex. -I paths, or link order), so
+  job kinds have to give them in a stable order."""
+  digest = hashlib.sha1()
+  for args, print_command in command_list:
+    digest.update('\0'.join(args))
+    digest.update('\n')
+  return digest.hexdigest()
+
+class DigestStore(object):
+  """Content digests of files, saved between builds.
+
+  Along with its digest, the size, mtime, and inode of each file are kept, and the file is only hashed again if one of
+  those has changed.
+  """
+
+  def __init__(self, filename, stat_cache):
+    self.__filename = filename
+    self.__stat_cache = stat_cache
+    self.__digest_dict = {}  #Path -> (size, mtime, inode, digest)
+    self.__lock = threading.Lock()
+    self.__changed = False
+
+    for path, v in JHMOutFile(filename, True).YieldSection():
+      if v is None:
+        continue
+      size, mtime, inode, digest = v.split()
+      self.__digest_dict[path] = (int(size), mtime, int(inode), digest)
+
+  def Get(self, path):
+    """Returns the digest of the file at path, or None if there isn't one."""
+    st = self.__stat_cache.Stat(path)
+    if st is None:
+      return None
+    stat_key = (st.st_size, repr(st.st_mtime), st.st_ino)
+
+    with self.__lock:
+      entry = self.__digest_dict.get(path)
+    if entry is not None and entry[:3] == stat_key:
+      return entry[3]
+
+    try:
+      digest = HashFile(path)
+    except IOError:
+      return None
+    with self.__lock:
+      self.__digest_dict[path] = stat_key + (digest,)
+      self.__changed = True
+    return digest
+
+  def Set(self, path, digest):
+    """Record the digest of the file at path as it is now, when it is already known (Ex. it was just hashed)."""
+    st = self.__stat_cache.Stat(path)
+    if st is None:
+      return
+    with self.__lock:
+      self.__digest_dict[path] = (st.st_size, repr(st.st_mtime), st.st_ino, digest)
+      self.__changed = True
+
+  def Save(self):
+    """Write out the digests if any have changed."""
+    with self.__lock:
+      if not self.__changed:
+        return
+      out_file = JHMOutFile(self.__filename, False)
+      for path, entry in self.__digest_dict.items():
+        out_file.Set('', path, '%s %s %s %s' % entry)
+      self.__changed = False
+    out_file.Save()
+
+class ClosureIndex(object):
+  """What jobs which use everything a file requires (Ex. links) need to know about each File, worked out once and shared
+  by all of them.
+
+  Siblings (the file with the same name, but a different last extension) are kept for the life of the Env, since which
+  files exist doesn't change while it's used. Anything else is only kept once its File is done, since until then what
+  the File requires (and its config) can still change.
+  """
+
+  def __init__(self):
+    self.__sibling_dict = {}  #(File, ext) -> sibling File, or None if it isn't available
+    self.__value_dict = {}    #(File, name) -> value
+    self.__lock = threading.Lock()
+
+  def GetSibling(self, f, ext):
+    """Get the available file with the same name as f, but ext as its last extension (Ex. the .o of a .cc), or None."""
+    key = (f, ext)
+    try:
+      return self.__sibling_dict[key]
+    except KeyError:
+      pass
+    sibling = f.GetRelatedFileAndTree(ext_list=f.ext_list[:-1] + [ext])
+    if not sibling or not sibling.is_available:
+      sibling = None
+    with self.__lock:
+      self.__sibling_dict[key] = sibling
+    return sibling
+
+  def GetClosure(self, file_set):
+    """Get the set of files in file_set, and everything they require."""
+    #A File's req_set already holds everything it requires indirectly, so there's no need to walk it.
+    closure = set(file_set)
+    for f in file_set:
+      closure |= f.req_set
+    return closure
+
+  def Get(self, f, name, func):
+    """Get func(f), keeping it under name once f is done."""
+    key = (f, name)
+    try:
+      return self.__value_dict[key]
+    except KeyError:
+      pass
+    value = func(f)
+    if f.done:
+      with self.__lock:
+        self.__value_dict[key] = value
+    return value
+
+  def Forget(self, file_set):
+    """Forget what was worked out about the given Files (They changed)."""
+    with self.__lock:
+      for key in [key for key in self.__value_dict if key[0] in file_set]:
+        del self.__value_dict[key]
+
+def LinkOrCopy(src, dest):
+  """Make dest the same file as src, by hard linking it if possible. dest is replaced atomically."""
+  tmp = '%s.jhm-tmp.%d.%d' % (dest, os.getpid(), threading.current_thread().ident)
+  try:
+    os.link(src, tmp)
+  except OSError:
+    shutil.copy2(src, tmp)
+  os.rename(tmp, dest)
+
+def CopyFresh(src, dest):
+  """Make dest a copy of src (which is never a link to it), with the current time as its mtime. dest is replaced
+  atomically."""
+  tmp = '%s.jhm-tmp.%d.%d' % (dest, os.getpid(), threading.current_thread().ident)
+  shutil.copyfile(src, tmp)
+  shutil.copymode(src, tmp)
+  os.rename(tmp, dest)
+
+def GetArtifactSettings(f):
+  """Get the flags the producer of f set in its cache, to be stored in an artifact cache along with f."""
+  #The command signature names paths in this out tree, and is recorded again whenever the job is.
+  return dict((section, dict(settings)) for section, settings in f.jhm_cache_file.settings_by_section.items()
+                if section != 'command')
+
+def SetArtifactSettings(f, settings_by_section):
+  """Put flags from an artifact cache back into the cache of f."""
+  for section, settings in settings_by_section.items():
+    for k, v in settings.items():
+      f.jhm_cache_file.Set(section, k, v)
+
+class ArtifactCache(object):
+  """A content addressed cache of the outputs of jobs, which can be shared by several out trees and checkouts.
+
+  Entries are keyed by Env.GetArtifactKey. Each entry is a directory holding the outputs of the job, along with a
+  manifest of the flags the job set in the caches of its outputs. Once the cache is bigger than max_size, the least
+  recently used entries are removed. Entries are stored by a pool of threads of their own, so whoever finishes a job
+  doesn't wait on the copying.
+  """
+
+  def __init__(self, path, max_size, num_threads):
+    self.__path = path
+    self.__max_size = max_size
+    self.__task_queue = Queue.Queue()
+    self.__lock = threading.Lock()
+    self.__num_hits = 0
+    self.__num_misses = 0
+    self.__num_stored = 0
+    for i in range(num_threads):
+      t = threading.Thread(target=self.__Work)
+      t.daemon = True
+      t.start()
+
+  def Restore(self, key, output_set, keep_unchanged):
+    """Put the outputs stored under key in place, adding the flags they were stored with to their caches. Returns
+    whether there was an entry for all of them.
+
+    Outputs are copied out of the entry rather than linked to it, since they have to look new to what uses them, and
+    giving a hard link a new mtime would change it for the entry (and every out tree linked to it) too. If
+    keep_unchanged is set, outputs which are already exactly what the entry holds are left alone, keeping their stamp."""
+    entry = self.__GetEntryPath(key)
+    manifest_filename = os.path.join(entry, 'manifest')
+    try:
+      with open(manifest_filename, 'r') as f:
+        manifest = ToStr(json.load(f))
+      if sorted(manifest) != sorted(f.rel_path for f in output_set):
+        raise ValueError('Entry %s does not have the expected outputs' % key)
+      for i, f in enumerate(sorted(output_set, key=lambda f: f.rel_path)):
+        stored = os.path.join(entry, str(i))
+        if not (keep_unchanged and os.path.exists(f.abs_path) and filecmp.cmp(stored, f.abs_path, False)):
+          EnsurePathExists(os.path.dirname(f.abs_path))
+          CopyFresh(stored, f.abs_path)
+        SetArtifactSettings(f, manifest[f.rel_path])
+      os.utime(manifest_filename, None)
+    except (EnvironmentError, ValueError):
+      with self.__lock:
+        self.__num_misses += 1
+      return False
+    with self.__lock:
+      self.__num_hits += 1
+    return True
+
+  def Store(self, key, output_set):
+    """Start storing the outputs of a job which just ran under key."""
+    output_list = [(f.rel_path, f.abs_path, GetArtifactSettings(f)) for f in sorted(output_set, key=lambda f: f.rel_path)]
+    self.__task_queue.put((key, output_list))
+
+  def Wait(self):
+    """Wait for every entry which has been started to be stored."""
+    self.__task_queue.join()
+
+  def __DoStore(self, key, output_list):
+    entry = self.__GetEntryPath(key)
+    if os.path.exists(entry):
+      return
+    tmp_entry = '%s.tmp.%d.%d' % (entry, os.getpid(), threading.current_thread().ident)
+    try:
+      EnsurePathExists(tmp_entry)
+      manifest = {}
+      for i, (rel_path, abs_path, settings) in enumerate(output_list):
+        LinkOrCopy(abs_path, os.path.join(tmp_entry, str(i)))
+        manifest[rel_path] = settings
+      with open(os.path.join(tmp_entry, 'manifest'), 'w') as f:
+        json.dump(manifest, f)
+      #Another build may have stored the same entry meanwhile, in which case theirs is just as good.
+      os.rename(tmp_entry, entry)
+    except EnvironmentError:
+      shutil.rmtree(tmp_entry, True)
+      return
+    with self.__lock:
+      self.__num_stored += 1
+
+  def Trim(self):
+    """Remove the least recently used entries until the cache fits in its max size."""
+    with self.__lock:
+      if not self.__num_stored:
+        return
+      self.__num_stored = 0
+    entry_list = []
+    total_size = 0
+    for bucket in os.listdir(self.__path):
+      bucket_path = os.path.join(self.__path, bucket)
+      if not os.path.isdir(bucket_path):
+        continue
+      for name in os.listdir(bucket_path):
+        entry = os.path.join(bucket_path, name)
+        try:
+          size = sum(os.path.getsize(os.path.join(entry, n)) for n in os.listdir(entry))
+          entry_list.append((os.path.getmtime(os.path.join(entry, 'manifest')), size, entry))
+        except OSError:
+          #Being written or removed by another build.
+          continue
+        total_size += size
+    entry_list.sort()
+    for mtime, size, entry in entry_list:
+      if total_size <= self.__max_size:
+        break
+      shutil.rmtree(entry, True)
+      total_size -= size
+
+  def Unshare(self, path):
+    """Remove path if it is a hard link (into the cache), so a command writing to it in place can't change the cache."""
+    try:
+      if os.lstat(path).st_nlink > 1:
+        os.unlink(path)
+    except OSError:
+      pass
+
+  def __GetEntryPath(self, key):
+    return os.path.join(self.__path, key[:2], key)
+
+  def __Work(self):
+    while True:
+      key, output_list = self.__task_queue.get()
+      try:
+        self.__DoStore(key, output_list)
+      except Exception:
+        traceback.print_exc()
+      finally:
+        self.__task_queue.task_done()
+
+  def __str__(self):
+    with self.__lock:
+      return '%d hits, %d misses' % (self.__num_hits, self.__num_misses)
+
+class RemoteArtifactCache(object):
+  """A cache of the outputs of jobs kept on a server, so they can be shared by many machines.
+
+  The protocol is plain HTTP GET and PUT. The contents of each output are stored by their sha1 digest at
+  <url>/cas/<digest>, and what a job made is stored at <url>/ac/<key> (see Env.GetArtifactKey) as a JSON manifest
+  mapping the rel_path of each output to its digest, mode, and the flags the job set in its cache. Transfers are done
+  by a pool of threads of their own. Anything going wrong is treated the same as the outputs not being there, and the
+  job is just run here. jhm_cache_server is a reference server.
+  """
+
+  #Seconds to wait on the server before giving up on a transfer.
+  TIMEOUT = 30
+
+  def __init__(self, url, num_threads):
+    self.__url = url.rstrip('/')
+    self.__task_queue = Queue.Queue()
+    self.__lock = threading.Lock()
+    self.__count_dict = {'hits': 0, 'misses': 0, 'errors': 0, 'stored': 0}
+    for i in range(num_threads):
+      t = threading.Thread(target=self.__Work)
+      t.daemon = True
+      t.start()
+
+  def Fetch(self, key, output_set, callback):
+    """Start fetching the outputs stored under key. Once done, callback is called (from another thread) with whether
+    they were all put in place."""
+    self.__task_queue.put((self.__DoFetch, (key, output_set, callback)))
+
+  def Store(self, key, output_set):
+    """Start uploading the outputs of a job which just ran under key."""
+    output_list = [(f.rel_path, f.abs_path, GetArtifactSettings(f)) for f in output_set]
+    self.__task_queue.put((self.__DoStore, (key, output_list)))
+
+  def Wait(self):
+    """Wait for every transfer which has been started to finish."""
+    self.__task_queue.join()
+
+  def __DoFetch(self, key, output_set, callback):
+    output_list = list(output_set)
+    tmp_list = []
+    result = 'errors'
+    try:
+      manifest = ToStr(json.loads(self.__Request('GET', 'ac/' + key)))
+      if sorted(manifest) != sorted(f.rel_path for f in output_list):
+        raise ValueError('Entry %s does not have the expected outputs' % key)
+      for f in output_list:
+        digest, mode, settings = manifest[f.rel_path]
+        data = self.__Request('GET', 'cas/' + digest)
+        if hashlib.sha1(data).hexdigest() != digest:
+          raise ValueError('Contents of %s do not match their digest' % digest)
+        EnsurePathExists(os.path.dirname(f.abs_path))
+        tmp = '%s.jhm-tmp.%d.%d' % (f.abs_path, os.getpid(), threading.current_thread().ident)
+        tmp_list.append(tmp)
+        with open(tmp, 'wb') as out:
+          out.write(data)
+        os.chmod(tmp, mode)
+      #Only put the outputs in place once we have all of them.
+      for tmp, f in zip(tmp_list, output_list):
+        os.rename(tmp, f.abs_path)
+        SetArtifactSettings(f, manifest[f.rel_path][2])
+      tmp_list = []
+      result = 'hits'
+    except urllib2.HTTPError as e:
+      if e.code == 404:
+        result = 'misses'
+    except (EnvironmentError, ValueError, TypeError, KeyError, httplib.HTTPException):
+      pass
+    finally:
+      for tmp in tmp_list:
+        if os.path.exists(tmp):
+          os.unlink(tmp)
+    with self.__lock:
+      self.__count_dict[result] += 1
+    callback(result == 'hits')
+
+  def __DoStore(self, key, output_list):
+    result = 'stored'
+    try:
+      manifest = {}
+      for rel_path, abs_path, settings in output_list:
+        with open(abs_path, 'rb') as f:
+          data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        self.__Request('PUT', 'cas/' + digest, data)
+        manifest[rel_path] = [digest, os.stat(abs_path).st_mode & 0777, settings]
+      #The manifest goes last, so no one can see it before what it names is there.
+      self.__Request('PUT', 'ac/' + key, json.dumps(manifest))
+    except (EnvironmentError, httplib.HTTPException):
+      result = 'errors'
+    with self.__lock:
+      self.__count_dict[result] += 1
+
+  def __Request(self, method, path, data=None):
+    request = urllib2.Request('%s/%s' % (self.__url, path), data)
+    request.get_method = lambda: method
+    response = urllib2.urlopen(request, timeout=RemoteArtifactCache.TIMEOUT)
+    try:
+      return response.read()
+    finally:
+      response.close()
+
+  def __Work(self):
+    while True:
+      func, args = self.__task_queue.get()
+      try:
+        func(*args)
+      except Exception:
+        traceback.print_exc()
+      finally:
+        self.__task_queue.task_done()
+
+  def __str__(self):
+    with self.__lock:
+      return ', '.join('%d %s' % (self.__count_dict[k], k) for k in ['hits', 'misses', 'errors', 'stored'])
 
 class MultithreadProcessingQueue(object):
-  """JHM-Specifc processing queue/set."""
-  def __init__(self, do_func, queue_item_func, num_cores, print_worker_stacks):
+  """JHM-Specifc processing queue/set.
+
+  Items are only handed to workers once everything they are waiting on has finished. An item which can't be finished
+  yet asks for what it needs through AddRequired while a worker is processing it. That registers the item as waiting on
+  each of the unfinished requirements, and the last of them to finish moves it back into the ready queue.
+
+  The ready queue is ordered by the longest known path from an item to something nobody waits on (a target), using
+  cost_func to estimate how long each item takes, so the slowest chains get started first.
+
+  If do_func returns DEFERRED, the item is still being worked on somewhere other than the worker threads. Whoever is
+  working on it must call FinishDeferred once it is done, or hand what is left of it back to the workers with Resume.
+
+  Items can need some amount of named resources (resource_func returns a dict of resource name -> amount) while they are
+  being worked on. An item is only handed to a worker if the amounts in use plus what it needs fit in capacity_dict.
+  Resources which aren't in capacity_dict are unlimited, and an item which needs more than the whole capacity of a
+  resource gets it all to itself.
+
+  Normally the first exception processing an item kills all the workers. With keep_going, only that item fails. Anything
+  waiting on it (or on something else which is waiting on it) is never processed, but everything else carries on.
+  """
+
+  DEFERRED = 'DEFERRED'
+
+  def __init__(self, do_func, queue_item_func, num_cores, print_worker_stacks, cost_func=lambda item: 0,
+               resource_func=lambda item: {}, capacity_dict={}, keep_going=False):
     #Stash for use.
     self.__do_func = do_func
+    self.__keep_going = keep_going
+    self.__print_worker_stacks = print_worker_stacks
     self.__queue_item_func = queue_item_func
+    self.__cost_func = cost_func
+    self.__resource_func = resource_func
+    self.__capacity_dict = dict(capacity_dict)
 
     #Task storage
-    self.__queue = []          #The priority queue of items to be worked on.
-    self.__queue_set = set()   #The set of items currently considered to be in the queue (queue | working_set)
+    self.__queue = []          #The priority queue of items which are ready to be worked on.
+    self.__queue_count = itertools.count()  #Tie breaker so items of equal priority come out in the order they went in.
+    self.__queue_set = set()   #The set of items currently considered to be in the queue (queue | running | waiting)
+    self.__running_set = set() #The set of items a worker is currently processing.
     self.__task_set = set()         #The full set of items which must be built
+    self.__waiter_dict = {}    #Item -> set of items which are waiting for it to finish.
+    self.__pending_dict = {}   #Item -> number of items it is still waiting on.
+    self.__priority_dict = {}  #Item -> estimated cost of the longest path from the item to a target.
+    self.__in_use_dict = dict((k, 0) for k in self.__capacity_dict)  #Resource -> amount used by running items.
+    self.__held_dict = {}      #Item -> the resources it holds.
+    self.__resource_wait = []  #Items which are ready, but waiting for enough resources to be released.
+    self.__failed_dict = {}    #Item -> the exception it failed with (Only when keep_going).
+    self.__resume_queue = collections.deque()  #(item, func) of deferred items to go on with, ahead of the ready queue.
     self.__lock = threading.Lock()  #The lock for all the above
 
+    #The item the current worker thread is processing, so AddRequired knows who is waiting.
+    self.__local = threading.local()
+
     #Messages to controller thread from workers.
     self.__worker_event = threading.Event()
     self.__worker_dead = threading.Event()
@@ -302,17 +1093,28 @@ class MultithreadProcessingQueue(object):
     def Worker():
       """Processesor of items in the queue."""
       def Get():
-        """Get something to do, warn others if there is now nothing to do"""
+        """Get something to do (and the func to go on with it if it is being resumed), warn others if there is now
+        nothing to do"""
         item = None
+        func = None
         with self.__lock:
-          if len(self.__queue) > 0:
-            item = self.__queue.pop(0)
-          if len(self.__queue) == 0:
+          if self.__resume_queue:
+            #Resumed items are still running, and hold their resources.
+            item, func = self.__resume_queue.popleft()
+          while len(self.__queue) > 0 and item is None:
+            item = heapq.heappop(self.__queue)[2]
+            if not self.__Acquire(item):
+              self.__resource_wait.append(item)
+              item = None
+          if item is not None:
+            self.__running_set.add(item)
+          if len(self.__queue) == 0 and not self.__resume_queue:
             self.__worker_go.clear()
-          return item
+          return item, func
 
       #Run as a worker until we're told otherwise
       while not self.__stop_workers.is_set():
+        item = None
         #Catch all exceptions, we only ever actually die if the stop_workers flag gets set.
         try:
           #Make sure we have something to do, then check if that something is to stop.
@@ -320,42 +1122,38 @@ class MultithreadProcessingQueue(object):
           if self.__stop_workers.is_set():
             continue
 
-          item = Get()
+          item, func = Get()
           if not item or self.__stop_workers.is_set():
             continue
 
-          self.__do_func(item, self.__print_lock)
-
-          with self.__lock:
-            self.__queue_set.remove(item)
-
-        except Exception, e:
-          #Immediately kill all other workers. Exceptions are fatal.
-          self.__stop_workers.set()
-          self.__worker_dead.set()
-          self.__worker_go.set()
-
-          #Print the error, or a stack trace if it is an internal error.
-          with self.__print_lock:
-            try:
-              if isinstance(e, BuildError):
-                print e
-                if print_worker_stacks:
-                  traceback.print_exc()
-              else:
-                traceback.print_exc()
-            except:
-              pass
+          self.__local.item = item
+          try:
+            result = func() if func else self.__do_func(item, self.__print_lock)
+          finally:
+            self.__local.item = None
+
+          if result is not MultithreadProcessingQueue.DEFERRED:
+            self.__Finish(item, result)
+
+        except Exception:
+          if self.__keep_going and item is not None:
+            self.__Fail(item, sys.exc_info())
+          else:
+            self.__Die(sys.exc_info())
         #Let the parent thread know that something happend (be it a job was processed, or we died).
         self.__worker_event.set()
 
-    self.__workers = map(lambda i: threading.Thread(
-                        name='Builder-%s'% i,
-                        target=Worker
-                        ), range(0, num_cores))
+    self.__num_cores = num_cores
+    self.__worker_func = Worker
+    self.__workers = []
 
   #With semantics to make it simple to run everything inserted to completion or error.
   def __enter__(self):
+    self.__stop_workers.clear()
+    self.__workers = map(lambda i: threading.Thread(
+                        name='Builder-%s'% i,
+                        target=self.__worker_func
+                        ), range(0, self.__num_cores))
     for w in self.__workers:
       w.start()
 
@@ -380,42 +1178,196 @@ class MultithreadProcessingQueue(object):
       #This isn't pretty, but python makes us, because there is no way to kill a hung thread.
       os._exit(-1)
 
-  #Used when going up the tree
-  def AddRequired(self, item_set):
-    """Add items in item_set to the queue if they aren't done, and add them to the needed set. Returns false if nothing is left to be done."""
+  def __Die(self, exc_info):
+    """Immediately kill all workers, printing the error which killed them. Exceptions are fatal."""
+    self.__stop_workers.set()
+    self.__worker_dead.set()
+    self.__worker_go.set()
+    self.__PrintError(exc_info)
+
+  def __Fail(self, item, exc_info):
+    """Mark item as failed, printing why. Nothing waiting on it will ever be woken up."""
+    self.__PrintError(exc_info)
+    with self.__lock:
+      self.__running_set.discard(item)
+      self.__Release(item)
+      self.__failed_dict[item] = exc_info[1]
+
+  def __PrintError(self, exc_info):
+    """Print the error, or a stack trace if it is an internal error."""
+    with self.__print_lock:
+      try:
+        if isinstance(exc_info[1], BuildError):
+          print exc_info[1]
+          if self.__print_worker_stacks:
+            traceback.print_exception(*exc_info)
+        else:
+          traceback.print_exception(*exc_info)
+      except:
+        pass
+
+  def __Acquire(self, item):
+    """Take the resources item needs if they are available. Returns whether they were. Must be called with the lock held."""
+    needed = dict((k, v) for k, v in self.__resource_func(item).items() if k in self.__capacity_dict)
+    for k, v in needed.items():
+      if self.__in_use_dict[k] > 0 and self.__in_use_dict[k] + v > self.__capacity_dict[k]:
+        return False
+    for k, v in needed.items():
+      self.__in_use_dict[k] += v
+    if needed:
+      self.__held_dict[item] = needed
+    return True
+
+  def __Release(self, item):
+    """Give back the resources held by item, letting everything waiting on resources try again. Must be called with the lock held."""
+    held = self.__held_dict.pop(item, None)
+    if held is None:
+      return
+    for k, v in held.items():
+      self.__in_use_dict[k] -= v
+    resource_wait = self.__resource_wait
+    self.__resource_wait = []
+    for waiting in resource_wait:
+      self.__Ready(waiting)
+
+  def __Finish(self, item, result):
+    """Record the result of processing item. Wakes up everything waiting on it if it finished."""
+    with self.__lock:
+      self.__running_set.remove(item)
+      self.__Release(item)
+      if result:
+        self.__queue_set.discard(item)
+        self.__pending_dict.pop(item, None)
+        self.__priority_dict.pop(item, None)
+        for waiter in self.__waiter_dict.pop(item, ()):
+          self.__pending_dict[waiter] -= 1
+          if self.__pending_dict[waiter] == 0 and waiter not in self.__running_set:
+            self.__Ready(waiter)
+      elif not self.__pending_dict.get(item, 0):
+        #Everything the item was waiting on finished before it was done being processed, so it needs another go.
+        self.__Ready(item)
+
+  def __Ready(self, item):
+    """Move an item which isn't waiting on anything into the queue. Must be called with the lock held."""
+    self.__pending_dict.pop(item, None)
+    heapq.heappush(self.__queue, (-self.__priority_dict.get(item, 0), next(self.__queue_count), item))
+    self.__worker_go.set()
+
+  def Reset(self):
+    """Forget everything which has been queued, including what failed or was left waiting, so the queue can be run
+    again. Must not be called while the queue is running."""
+    with self.__lock:
+      self.__queue = []
+      self.__queue_set = set()
+      self.__running_set = set()
+      self.__task_set = set()
+      self.__waiter_dict = {}
+      self.__pending_dict = {}
+      self.__priority_dict = {}
+      self.__in_use_dict = dict((k, 0) for k in self.__capacity_dict)
+      self.__held_dict = {}
+      self.__resource_wait = []
+      self.__failed_dict = {}
+      self.__resume_queue = collections.deque()
+    self.__worker_dead.clear()
+    self.__worker_go.clear()
+
+  def FinishDeferred(self, item, exc_info=None):
+    """Finish an item which do_func returned DEFERRED for. If finishing it failed, exc_info is the exception why."""
+    if exc_info and self.__keep_going:
+      self.__Fail(self.__queue_item_func(item), exc_info)
+    elif exc_info:
+      self.__Die(exc_info)
+    else:
+      self.__Finish(self.__queue_item_func(item), True)
+    #Let the parent thread know something happened.
+    self.__worker_event.set()
+
+  def Resume(self, item, func):
+    """Go on with an item which do_func returned DEFERRED for on a worker thread. func is called there, and what it
+    returns is handled just like what do_func returns."""
+    with self.__lock:
+      self.__resume_queue.append((self.__queue_item_func(item), func))
+      self.__worker_go.set()
+
+  def AddRequired(self, item_set, block=True):
+    """Add items in item_set to the queue if they aren't done, and add them to the needed set. Returns false if nothing is left to be done.
+
+    If block is true and this is called while a worker is processing an item, that item will wait for all the unfinished
+    items to be finished before it is put back in the queue."""
     with self.__lock:
       self.__task_set |= set(self.__queue_item_func(item) for item in item_set)
       unfinished = set(self.__queue_item_func(item) for item in filter(lambda x: not x.done, item_set))
       if len(unfinished) == 0:
         return False
+
+      waiter = getattr(self.__local, 'item', None) if block else None
+
+      #Everything the waiter needs is on a path to a target at least as long as the waiter's.
+      waiter_priority = self.__priority_dict.get(waiter, 0)
+      for item in unfinished:
+        priority = waiter_priority + self.__cost_func(item)
+        if priority > self.__priority_dict.get(item, 0):
+          self.__priority_dict[item] = priority
+
+      if waiter is not None:
+        for item in unfinished - set([waiter]):
+          waiter_set = self.__waiter_dict.setdefault(item, set())
+          if waiter not in waiter_set:
+            waiter_set.add(waiter)
+            self.__pending_dict[waiter] = self.__pending_dict.get(waiter, 0) + 1
+
       unfinished  -= self.__queue_set
       self.__queue_set |= unfinished
-      self.__queue += list(unfinished)
-      self.__worker_go.set()
+      for item in unfinished:
+        self.__Ready(item)
       return True
 
-  #Used when going down the tree.
-  def AddIfNeeded(self, item_set):
-    """Adds items in item_set to the queue if they aren't done, but only if they are in the needed set.  Returns false if nothing is left to be done."""
+  @property
+  def working(self):
+    """Whether there is anything to do or being done. Items which are only waiting on each other can never be finished."""
     with self.__lock:
-      item_set = set(self.__queue_item_func(item) for item in filter(lambda item: not item.done, item_set)) & self.__task_set
-      if len(item_set) == 0:
-        return False
-      item_set -= self.__queue_set
-      self.__queue_set |= item_set
-      self.__queue += list(item_set)
-      self.__worker_go.set()
-      return True
+      return len(self.__queue) > 0 or len(self.__running_set) > 0 or len(self.__resource_wait) > 0
 
   @property
-  def working(self):
+  def failed_dict(self):
+    """Dict of the items which failed to the exception they failed with."""
+    with self.__lock:
+      return dict(self.__failed_dict)
+
+  @property
+  def stalled_set(self):
+    """The set of items which never finished because something they were waiting on did not."""
     with self.__lock:
-      return len(self.__queue_set) > 0
+      return frozenset(self.__queue_set - set(self.__failed_dict) - self.__running_set)
 
   @property
   def worker_dead(self):
     return self.__worker_dead.is_set()
 
+def GetFileStamp(path):
+  """Get what tells if the file at path has changed (its mtime, size, and inode), or None if it doesn't exist."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+jhm_file_dict = {}  #Path -> the JHMFile parsed from it
+jhm_file_lock = threading.Lock()
+
+def LoadJHMFile(filename):
+  """Get the JHMFile for the given config file. Files are only parsed again once they (or one of their parents) change,
+  so a parent shared by lots of .jhm files is only read once, and Envs made later (Ex. by jhm_server) reuse them."""
+  with jhm_file_lock:
+    jhm_file = jhm_file_dict.get(filename)
+  if jhm_file is not None and jhm_file.IsCurrent():
+    return jhm_file
+  jhm_file = JHMFile(filename)
+  with jhm_file_lock:
+    jhm_file_dict[filename] = jhm_file
+  return jhm_file
+
 class JHMFile(object):
   """Standard JHM configuration file."""
 
@@ -448,6 +1400,8 @@ class JHMFile(object):
     section = ''
     self.__settings_by_section[section] = {}
     self.__parent = None
+    self.__filename = filename
+    self.__stamp = GetFileStamp(filename) if filename is not None else None
     if filename is not None:
       try:
         for line in open(filename, 'r'):
@@ -468,35 +1422,44 @@ class JHMFile(object):
                 fname = v
                 if not os.path.isabs(fname):
                   fname = os.path.join(os.path.dirname(filename), fname)
-                self.__parent = JHMFile(fname)
+                self.__parent = LoadJHMFile(fname)
             self.__settings_by_section[section][k] = (v if v else None)
       except IOError as e:
         if e.errno == 2:
           raise BuildError('config file "%s" does not exist' % filename)
         raise
 
+    #Flatten the parent chain once, so lookups don't have to walk it. Get only looks in the parent for sections we have,
+    #while YieldSection merges every section of the parent in. Without a parent both are just our own settings (Which
+    #JHMOutFile changes in place).
+    if self.__parent:
+      parent_get_dict = self.__parent.__get_dict
+      parent_yield_dict = self.__parent.__yield_dict
+      self.__get_dict = dict((s, dict(parent_get_dict.get(s, {}), **settings))
+                             for s, settings in self.__settings_by_section.items())
+      self.__yield_dict = dict((s, dict(parent_yield_dict.get(s, {}), **self.__settings_by_section.get(s, {})))
+                               for s in set(parent_yield_dict) | set(self.__settings_by_section))
+    else:
+      self.__get_dict = self.__yield_dict = self.__settings_by_section
+
   def Get(self, key, section='', default=None):
     """Get the given key in the given section, returning default if the key doesn't exist"""
     if section is None:
       section = ''
 
-    if self.__settings_by_section.has_key(section):
-      return self.__settings_by_section[section].get(key, self.__parent.Get(key, section, default) if self.__parent else default)
-    else:
-      return default
+    settings = self.__get_dict.get(section)
+    return settings.get(key, default) if settings is not None else default
+
+  def IsCurrent(self):
+    """Whether the file (and its parents) are unchanged since they were parsed."""
+    return self.__stamp == GetFileStamp(self.__filename) and (self.__parent is None or self.__parent.IsCurrent())
 
   def YieldSection(self, section=''):
     """Yield all k,v pairs in the given section"""
     if section is None:
       section = ''
 
-    if self.__parent:
-      yield_dict = dict(self.__parent.YieldSection(section), **self.__settings_by_section.get(section,{}))
-    else:
-      yield_dict = self.__settings_by_section.get(section, {})
-
-    for k, v in yield_dict.items():
-      yield k, v
+    return self.__yield_dict.get(section, {}).items()
 
   @property
   def settings_by_section(self):
@@ -507,25 +1470,394 @@ class JHMOutFile(JHMFile):
 
   def __init__(self, filename, read_file):
     self.__filename = filename
+    self.on_change = None  #Called whenever a setting is changed.
     JHMFile.__init__(self, filename if read_file and os.path.exists(filename) else None)
 
   def Set(self, section, key, value=None):
     if section is None:
       section = ''
     self.settings_by_section.setdefault(section,{})[key] = value
+    if self.on_change is not None:
+      self.on_change()
+
+
+  def GetText(self):
+    """Get the settings as they are written out."""
+    lines = []
+    for k, v in self.settings_by_section.items():
+      if k != '':
+        lines.append('+%s' % k)
+      for k_, v_ in v.items():
+        if v_ is not None:
+          lines.append('%s=%s' % (k_, v_))
+        else:
+          lines.append(k_)
+    return ''.join(line + '\n' for line in lines)
 
+  def Save(self):
+    WriteFileAtomically(self.__filename, self.GetText())
+
+def WriteFileAtomically(filename, text, stamp=None):
+  """Replace the file at filename with text. It's written to a temporary file which is renamed over it, so it's never seen
+  half written (Ex. if the build is killed). If the file already has text in it, it isn't written again. If stamp is
+  given, the file's mtime is set to it either way."""
+  try:
+    with open(filename, 'r') as f:
+      unchanged = f.read() == text
+  except IOError:
+    unchanged = False
+
+  if unchanged:
+    if stamp is not None:
+      os.utime(filename, (stamp, stamp))
+    return
+  EnsurePathExists(os.path.dirname(filename))
+  tmp_filename = '%s.jhm-tmp.%d.%d' % (filename, os.getpid(), threading.current_thread().ident)
+  with open(tmp_filename, 'w') as f:
+    f.write(text)
+  if stamp is not None:
+    os.utime(tmp_filename, (stamp, stamp))
+  os.rename(tmp_filename, filename)
+
+class FileSystemClock(object):
+  """Tells the time by the clock of the file system a file is on, rather than the local clock. Stamps compared against
+  the mtimes of files (Ex. to decide if a cache is fresh) have to come from the same clock as them, which over NFS (or
+  any network file system) the local clock isn't.
+
+  How far off the local clock is gets measured by touching the file, which the file system gives its own time."""
+
+  def __init__(self, filename):
+    self.__filename = filename
+    self.__offset = None
+
+  def Sync(self):
+    """Touch our file (Making it if it doesn't exist), and measure the local clock against its new mtime."""
+    EnsurePathExists(os.path.dirname(self.__filename))
+    with open(self.__filename, 'a'):
+      os.utime(self.__filename, None)
+    #Taken after the touch, so the stamps we give are never later than the file system's time.
+    now = time.time()
+    self.__offset = os.stat(self.__filename).st_mtime - now
+
+  def Time(self):
+    """The current time, by the file system's clock."""
+    if self.__offset is None:
+      self.Sync()
+    return time.time() + self.__offset
+
+class BackgroundWriter(object):
+  """Does writes (Ex. of caches) on a thread of its own, one at a time in the order they're given, so threads which save
+  things don't have to wait on the disk. Anything not yet written when the program exits is written then."""
+
+  def __init__(self):
+    self.__queue = collections.deque()
+    self.__cond = threading.Condition()
+    self.__running = False  #Whether the writer thread is running (It exits whenever there is nothing left to write).
+    self.__exc_info = None  #The first error a write hit, until Flush raises it.
+    atexit.register(self.Flush)
+
+  def Submit(self, func):
+    """Have func called on the writer thread once everything submitted before it has been."""
+    with self.__cond:
+      self.__queue.append(func)
+      if not self.__running:
+        self.__running = True
+        thread = threading.Thread(target=self.__Run, name='jhm-writer')
+        thread.daemon = True
+        thread.start()
+
+  def Flush(self):
+    """Wait for everything submitted so far to be written. Raises the error the first write to fail hit, if any did."""
+    with self.__cond:
+      while self.__running:
+        self.__cond.wait()
+      exc_info, self.__exc_info = self.__exc_info, None
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def __Run(self):
+    while True:
+      with self.__cond:
+        if not self.__queue:
+          self.__running = False
+          self.__cond.notify_all()
+          return
+        func = self.__queue.popleft()
+      try:
+        func()
+      except Exception:
+        with self.__cond:
+          if self.__exc_info is None:
+            self.__exc_info = sys.exc_info()
+
+#Writes caches for every Env.
+background_writer = BackgroundWriter()
+
+def ToStr(value):
+  """Convert the unicode strings json gives back in a value to plain strings."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  elif isinstance(value, list):
+    return [ToStr(v) for v in value]
+  elif isinstance(value, dict):
+    return dict((ToStr(k), ToStr(v)) for k, v in value.items())
+  return value
+
+class FileCacheStore(object):
+  """Keeps the cache of each File in its own '<rel_path>.jhm-cache' file in the output tree.
+
+  Saved caches are written by the background writer. Until they are, they're answered from memory. The mtime of each
+  cache file is set to when it was saved (by the output tree's clock), rather than when it happened to be written."""
+
+  def __init__(self, out_tree, writer):
+    self.__out_tree = out_tree
+    self.__writer = writer
+    self.__clock = FileSystemClock(out_tree.GetAbsPath('.jhm-clock'))
+    self.__pending_dict = {}  #rel_path -> (stamp, settings_by_section) saved, but not written yet
+    self.__lock = threading.Lock()
+
+  def Flush(self):
+    """Wait for all saved caches to be written."""
+    self.__writer.Flush()
+
+  def GetStamp(self, rel_path):
+    """Returns when the cache for rel_path was last saved, or 0 if it never has been."""
+    with self.__lock:
+      entry = self.__pending_dict.get(rel_path)
+    return entry[0] if entry else GetTimestamp(self.__GetFilename(rel_path))
+
+  def Open(self, rel_path, read_file):
+    """Get the cache for rel_path. If read_file is false, it starts out empty."""
+    with self.__lock:
+      entry = self.__pending_dict.get(rel_path) if read_file else None
+    if entry is not None:
+      settings_by_section = entry[1]
+    elif read_file:
+      settings_by_section = JHMOutFile(self.__GetFilename(rel_path), True).settings_by_section
+    else:
+      settings_by_section = {}
+    return StoredCacheFile(self, rel_path, settings_by_section)
+
+  def Put(self, rel_path, settings_by_section):
+    """Save the cache for rel_path."""
+    stamp = self.__clock.Time()
+    settings_by_section = dict((section, dict(settings)) for section, settings in settings_by_section.items())
+    with self.__lock:
+      #If it's already waiting to be written, whatever writes it will see this version.
+      submit = rel_path not in self.__pending_dict
+      self.__pending_dict[rel_path] = (stamp, settings_by_section)
+    if submit:
+      self.__writer.Submit(lambda: self.__Write(rel_path))
+
+  def __Write(self, rel_path):
+    with self.__lock:
+      entry = self.__pending_dict[rel_path]
+    out_file = JHMOutFile(None, False)
+    out_file.settings_by_section.update(entry[1])
+    WriteFileAtomically(self.__GetFilename(rel_path), out_file.GetText(), entry[0])
+    with self.__lock:
+      #It may have been saved again while being written.
+      submit = self.__pending_dict[rel_path] is not entry
+      if not submit:
+        del self.__pending_dict[rel_path]
+    if submit:
+      self.__writer.Submit(lambda: self.__Write(rel_path))
+
+  def __GetFilename(self, rel_path):
+    return self.__out_tree.GetAbsPath(rel_path + '.jhm-cache')
+
+class StoredCacheFile(JHMOutFile):
+  """The cache of a File which is kept by a cache store, which decides when and how it's written."""
+
+  def __init__(self, store, rel_path, settings_by_section):
+    JHMOutFile.__init__(self, None, False)
+    self.__store = store
+    self.__rel_path = rel_path
+    for section, settings in settings_by_section.items():
+      self.settings_by_section[section] = dict(settings)
 
   def Save(self):
+    self.__store.Put(self.__rel_path, self.settings_by_section)
+
+class LogCacheStore(object):
+  """Keeps the caches of all Files in a single append-only log in the output tree.
+
+  The whole log is read once when the store is created. Saved caches are appended to it in batches, and once most of the
+  log is entries which have been superseded, it is rewritten with just the latest entry for each File. Appending and
+  rewriting are done holding a lock on '<log>.lock', since other builds of the same out tree may be writing to it too.
+
+  Caches are stamped by the clock of the file system the log is on, which is synced each time the log is written.
+  """
+
+  #Number of saved caches to hold on to before appending them to the log.
+  BATCH_SIZE = 256
+
+  def __init__(self, filename, writer):
+    self.__filename = filename
+    self.__writer = writer
+    self.__entry_dict = {}    #rel_path -> (stamp, settings_by_section)
+    self.__num_records = 0    #Number of entries in the log on disk, including superseded ones.
+    self.__pending_list = []  #Entries which haven't been appended to the log yet.
+    self.__write_submitted = False
+    self.__lock = threading.Lock()
+    self.__clock = FileSystemClock(filename)
+
+    for rel_path, entry in LogCacheStore.__ReadLog(filename):
+      self.__entry_dict[rel_path] = entry
+      self.__num_records += 1
+
+  @staticmethod
+  def __ReadLog(filename):
+    """Yield (rel_path, (stamp, settings_by_section)) for each entry in the log, oldest first."""
+    if not os.path.exists(filename):
+      return
+    for line in open(filename, 'r'):
+      try:
+        rel_path, stamp, settings_by_section = ToStr(json.loads(line))
+      except ValueError:
+        #A build which was killed part way through writing can leave a partial entry behind.
+        continue
+      yield rel_path, (stamp, settings_by_section)
+
+  def Flush(self):
+    """Commit all saved caches to the log."""
+    self.__writer.Submit(self.__Write)
+    self.__writer.Flush()
+
+  def __Write(self):
+    """Write out the pending entries (on the writer thread). Saved caches are only held in memory long enough to take
+    the ones waiting to be written."""
+    with self.__lock:
+      self.__write_submitted = False
+      pending_list = self.__pending_list
+      self.__pending_list = []
+      entry_dict = None
+      if self.__num_records + len(pending_list) > 2 * len(self.__entry_dict) + LogCacheStore.BATCH_SIZE:
+        #Entries are never changed once put, so they can be written out after letting go of the lock.
+        entry_dict = dict(self.__entry_dict)
+        self.__num_records = len(entry_dict)
+      else:
+        self.__num_records += len(pending_list)
+
+    if entry_dict is None and not pending_list:
+      return
     EnsurePathExists(os.path.dirname(self.__filename))
-    with open(self.__filename, 'w') as f:
-      for k, v in self.settings_by_section.items():
-        if k != '':
-          print>>f, '+%s' % k
-        for k_, v_ in v.items():
-          if v_ is not None:
-            print>>f, '%s=%s' % (k_, v_)
-          else:
-            print>>f, k_
+    with open(self.__filename + '.lock', 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      if entry_dict is not None:
+        #Whatever other builds have appended since we read the log is kept, unless we have a newer entry for the File.
+        for rel_path, entry in LogCacheStore.__ReadLog(self.__filename):
+          if entry[0] > entry_dict.get(rel_path, (0, None))[0]:
+            entry_dict[rel_path] = entry
+        #Rewritten with just the latest entry for each File, and renamed over the log so a killed build can't lose it.
+        WriteFileAtomically(self.__filename, ''.join(json.dumps([rel_path, stamp, settings_by_section]) + '\n'
+                                                     for rel_path, (stamp, settings_by_section) in entry_dict.items()))
+      else:
+        with open(self.__filename, 'a') as f:
+          for line in pending_list:
+            print>>f, line
+    self.__clock.Sync()
+
+  def GetStamp(self, rel_path):
+    """Returns when the cache for rel_path was last saved, or 0 if it never has been."""
+    with self.__lock:
+      entry = self.__entry_dict.get(rel_path)
+    return entry[0] if entry else 0
+
+  def Open(self, rel_path, read_file):
+    """Get the cache for rel_path. If read_file is false, it starts out empty."""
+    with self.__lock:
+      entry = self.__entry_dict.get(rel_path) if read_file else None
+    return StoredCacheFile(self, rel_path, entry[1] if entry else {})
+
+  def Put(self, rel_path, settings_by_section):
+    """Save the cache for rel_path."""
+    stamp = self.__clock.Time()
+    settings_by_section = dict((section, dict(settings)) for section, settings in settings_by_section.items())
+    with self.__lock:
+      self.__entry_dict[rel_path] = (stamp, settings_by_section)
+      self.__pending_list.append(json.dumps([rel_path, stamp, settings_by_section]))
+      submit = len(self.__pending_list) >= LogCacheStore.BATCH_SIZE and not self.__write_submitted
+      if submit:
+        self.__write_submitted = True
+    #The builder thread doesn't wait for the batch to be written.
+    if submit:
+      self.__writer.Submit(self.__Write)
+
+class GraphSnapshot(object):
+  """What every target needed the last time it was built, so targets for which none of that has changed can be skipped
+  without building their part of the graph at all.
+
+  For each target, the snapshot has the paths of every file (and .jhm file) it was built from, and the directories
+  in the input trees those are in (So new files which would change how things are found are noticed). Along with those,
+  the stat of each path is kept. The whole snapshot is only used if the options and the config paths (config files,
+  job and file kinds, JHM itself) are the same as they were."""
+
+  def __init__(self, filename, stat_cache, fingerprint, config_path_list):
+    self.__filename = filename
+    self.__stat_cache = stat_cache
+    self.__fingerprint = fingerprint
+    self.__config_path_list = config_path_list
+    self.__target_dict = {}   #Target rel_path -> list of paths it needed
+    self.__stamp_dict = {}    #Path -> stamp when it was last needed
+    self.__clean_dict = {}    #Path -> whether it's unchanged since the snapshot was taken
+    self.__changed = False
+
+    try:
+      with open(filename, 'r') as f:
+        snapshot = ToStr(json.load(f))
+    except (IOError, ValueError):
+      return
+    if snapshot.get('fingerprint') != fingerprint:
+      return
+    config_dict = snapshot.get('config', {})
+    if sorted(config_dict) != sorted(config_path_list) or any(config_dict[p] != self.__GetStamp(p) for p in config_path_list):
+      return
+    self.__target_dict = snapshot.get('targets', {})
+    self.__stamp_dict = snapshot.get('stamps', {})
+
+  def IsClean(self, rel_path):
+    """Whether the target with the given rel_path has been built, and nothing it needed has changed since."""
+    path_list = self.__target_dict.get(rel_path)
+    if path_list is None:
+      return False
+    for path in path_list:
+      clean = self.__clean_dict.get(path)
+      if clean is None:
+        clean = self.__clean_dict[path] = self.__stamp_dict.get(path, False) == self.__GetStamp(path)
+      if not clean:
+        return False
+    return True
+
+  def Record(self, rel_path, path_set):
+    """Record the paths the target with the given rel_path was just built from."""
+    self.__target_dict[rel_path] = sorted(path_set)
+    for path in path_set:
+      self.__stamp_dict[path] = self.__GetStamp(path)
+    self.__changed = True
+
+  def Save(self):
+    """Write out the snapshot if any target was recorded."""
+    if not self.__changed:
+      return
+    #Only keep stamps of paths some target still needs.
+    needed = set(chain.from_iterable(self.__target_dict.values()))
+    snapshot = {
+        'fingerprint': self.__fingerprint,
+        'config': dict((path, self.__GetStamp(path)) for path in self.__config_path_list),
+        'targets': self.__target_dict,
+        'stamps': dict((path, stamp) for path, stamp in self.__stamp_dict.items() if path in needed),
+      }
+    EnsurePathExists(os.path.dirname(self.__filename))
+    tmp_filename = self.__filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+      json.dump(snapshot, f)
+    os.rename(tmp_filename, self.__filename)
+    self.__changed = False
+
+  def __GetStamp(self, path):
+    st = self.__stat_cache.Stat(path)
+    return [repr(st.st_mtime), st.st_size] if st is not None else None
 
 def GetArgParser():
   """Get an argument parser for a JHM Env. The argument parser builds the options namespace for the Env."""
@@ -540,8 +1872,24 @@ def GetArgParser():
       help='Level of verbosity to use when compiling. More repititions means more verbose.')
   parser.add_argument('-I', '--inc-tree', dest='inc_trees', action='append', default=[],
       help='A path to use as a tree for input that isn\'t the primary source tree.')
+  parser.add_argument('-k', '--keep-going', dest='keep_going', action='store_true', default=False,
+      help='Keep building everything which doesn\'t depend on a failed job, rather than stopping at the first error.')
   parser.add_argument('-f','--force', dest='force', action='store_true', default=False,
       help='Force full recompilation.')
+  parser.add_argument('--cache-store', dest='cache_store', action='store', default=None, choices=['log', 'file'],
+      help='Keep the caches of all files in a single log (log), or in a .jhm-cache file per file (file). Default is log.')
+  parser.add_argument('--digest', dest='digest', action='store_true', default=False,
+      help='Decide what is out of date by the contents of files, rather than their timestamps.')
+  parser.add_argument('--no-restat', dest='no_restat', action='store_true', default=False,
+      help='Give everything a job makes a new stamp, even if it is exactly the same as it was before.')
+  parser.add_argument('--artifact-cache', dest='artifact_cache', action='store', default=None,
+      help='A directory to keep the outputs of jobs in, so identical jobs (in any out tree or checkout) only run once.')
+  parser.add_argument('--artifact-cache-size', dest='artifact_cache_size', action='store', default=None,
+      help='How big the artifact cache can get before the least recently used outputs are removed. Default is 5G.')
+  parser.add_argument('--remote-cache', dest='remote_cache', action='store', default=None,
+      help='URL of a server to share the outputs of jobs with other machines through (see jhm_cache_server).')
+  parser.add_argument('--no-graph-snapshot', dest='no_graph_snapshot', action='store_true', default=False,
+      help='Build the graph of every target, even if nothing it needed has changed since it was last built.')
   parser.add_argument('--src-dir', dest='src_dir', action='store', default=None,
       help='The directory which contains the project source.')
   parser.add_argument('--out-dir', dest='out_dir', action='store', default=None,
@@ -556,8 +1904,16 @@ def GetArgParser():
       help='The directory where user configuration is located.')
   parser.add_argument('--num-cores', dest='num_cores', action='store', default=None, type=int,
       help='The number of threads to concurrent builders allow. Default is the number of cores in your machine.')
+  parser.add_argument('--num-procs', dest='num_procs', action='store', default=None, type=int,
+      help='The number of commands to run at once. Default is the number of builder threads (--num-cores).')
+  parser.add_argument('--resource', dest='resources', action='append', default=[],
+      help='How much of a named resource jobs can use at once (Ex. link=2, memory=16G). Overrides the resources config section.')
   parser.add_argument('--no-auto-targets', dest='no_auto_targets', action='store_true', default=False,
       help='Do not use targets listed in the jhm file no matter what.')
+  parser.add_argument('-w', '--watch', dest='watch', action='store_true', default=False,
+      help='After building, keep watching what the build used, and build again whenever some of it changes.')
+  parser.add_argument('--no-server', dest='no_server', action='store_true', default=False,
+      help='Build in this process, even if a jhm_server is running for the project.')
   parser.add_argument('-x', '--exec', dest='exec_targets', action='store_true', default=False,
       help='Execute all executables after successful build.')
   parser.add_argument('--jhm-debug', dest='jhm_debug', action='store_true', default=False,
@@ -589,7 +1945,7 @@ class Config(object):
     for fname in conf_fname_list:
       config_fullpath = os.path.join(config_root, fname)
       if os.path.isfile(config_fullpath):
-        self.__config = JHMFile(config_fullpath)
+        self.__config = LoadJHMFile(config_fullpath)
         break
 
     def TryLoadList(list_name):
@@ -720,10 +2076,11 @@ class Tree(object):
 class JobKind(object):
   """A transformation that can be applied to a file to produce other files."""
 
-  def __init__(self, name, in_ext, out_exts):
+  def __init__(self, name, in_ext, out_exts, resources=None):
     self.__name = name
     self.__in_ext = in_ext
     self.__out_exts = set(out_exts) if out_exts is not None else set()
+    self.__resources = dict((k, ParseAmount(v) if isinstance(v, str) else v) for k, v in (resources or {}).items())
 
   def GetBaseDepends(self, job):
     """Gets any depends of the job which only need to be found once (such as a file list stored somewhere"""
@@ -745,6 +2102,22 @@ class JobKind(object):
     """Returns a function which, when called, will produce the output_set of the given job."""
     raise NotImplementedError(self)
 
+  def Finish(self, job):
+    """Called once the commands of the given job have all run successfully, to take in anything they found out (Ex. a
+    depfile of what was included)."""
+    pass
+
+  def RunCommands(self, job, command_list, on_success):
+    """Run the (args, print_command) commands the runner of the given job collected, without waiting for them. Job kinds
+    can run them some other way (Ex. along with those of other jobs), as long as the job is finished like
+    Env.RunDeferred does."""
+    job.env.RunDeferred(job, command_list, on_success)
+
+  def IsCacheable(self, job):
+    """Whether the outputs of the given job can be shared through artifact caches. They can't if what the job reads
+    isn't all known until it runs, since the cache key is made from what it reads."""
+    return True
+
   @property
   def in_ext(self):
     return self.__in_ext
@@ -757,6 +2130,11 @@ class JobKind(object):
   def out_exts(self):
     return self.__out_exts
 
+  @property
+  def resources(self):
+    """Dict of named resources (Ex. 'link', 'memory') and the amount of each a job of this kind uses while running."""
+    return self.__resources
+
   def __str__(self):
     return self.__name
 
@@ -806,9 +2184,31 @@ class FileKindNoIncl(FileKind):
     return frozenset()
 
 
+class LockStripes(object):
+  """A fixed number of locks, shared by any number of objects (Each uses the one its key hashes to), so graphs with lots
+  of nodes don't need a lock for every one. Code holding one of the locks must never wait on another from the same
+  stripes, since another thread may be holding it for an unrelated object."""
+
+  def __init__(self, num_locks=256):
+    self.__lock_list = [threading.RLock() for _ in xrange(num_locks)]
+
+  def Get(self, key):
+    """Get the lock for the given key."""
+    return self.__lock_list[hash(key) % len(self.__lock_list)]
+
+#Empty set for Files which nothing has been added to yet. Replaced with a set of their own on the first add.
+EMPTY_SET = frozenset()
+
 class Job(object):
   """A JobKind which has been assigned an input or output file."""
 
+  #Jobs are kept for every output in the graph, so they're kept compact.
+  __slots__ = ('__env', '__hash', '__kind', '__input', '__done', '__out_only', '__depend_set', '__output_set',
+               '__output_dir', '__dep_lock', '__base_deps')
+
+  #The dep_lock of every Job. It's only held while changing or queuing the depend_set.
+  dep_locks = LockStripes()
+
   @staticmethod
   def Hash(kind, in_file):
     """Hash of the given job for interning"""
@@ -826,7 +2226,7 @@ class Job(object):
     self.__output_set = set() if self.__input else frozenset([in_file])
     self.__output_dir = os.path.dirname(in_file.env.out_tree.GetAbsPath(in_file.rel_path))
 
-    self.__dep_lock = threading.RLock()
+    self.__dep_lock = Job.dep_locks.Get(self.__hash)
     self.__base_deps = False
 
     if not out_only:
@@ -850,38 +2250,161 @@ class Job(object):
       dep.AddConsumer(self)
       for f in self.__output_set:
         dep.AddUser(f)
+    #If we've already been asked to build, start on what we now depend on rather than waiting to be retried to find it.
+    if self.__base_deps and new_deps:
+      self.__env.Queue(new_deps, False)
 
   def Build(self):
     """Attempt to build the given job."""
     assert not self.__done
 
-    #Queue anything we depend on that isn't done yet.
+    #Queue anything we depend on that isn't done yet. The base depends are added without holding our lock, since adding
+    #them can add depends to other jobs too.
     if not self.__base_deps:
       with self.__dep_lock:
-        if not self.__base_deps:
-          self.__base_deps = True
-          self.__DoAddDepends(self.kind.GetBaseDepends(self))
+        add_base_deps = not self.__base_deps
+        self.__base_deps = True
+      if add_base_deps:
+        self.__DoAddDepends(self.kind.GetBaseDepends(self))
 
     with self.__dep_lock:
       if self.__env.Queue(self.__depend_set):
         return False
 
-    #Make the directory to the out file(s), and setup their caches so flags can be added.
+    #Make the directory to the out file(s), and setup their caches so flags can be added. Outputs which aren't finished
+    #yet give back the command signature their cache was written with, if it's still fresh.
+    signature_dict = {}
     for f in self.output_set:
       EnsurePathExists(os.path.dirname(f.abs_path))
-      f.FinishNoCache()
+      signature = f.BeginProduce()
+      if signature is not False:
+        signature_dict[f] = signature
+
+    #Run the job, keeping track of how long it took so future builds can start long job chains first. Build commands the
+    #runner issues are handed off to the env's command executor, so this thread can go back to working on the graph.
+    start = time.time()
+    command_list = self.__env.CollectCommands(self.__kind.GetRunner(self))
+    runner_time = time.time() - start
+
+    #If every output we still owe was made by exactly these commands, there's nothing to run.
+    #Outputs nothing has asked for as a File (Ex. a .hi which nothing imports) never have their cache saved, so they
+    #can't tell if the commands changed. As long as they exist, it's left to the outputs which can.
+    signature = GetCommandSignature(command_list)
+    signature_list = [s for f, s in signature_dict.iteritems()
+                      if s is not None or f.cache_saved or self.__env.stat_cache.Stat(f.abs_path) is None]
+    run = not signature_list or any(s != signature for s in signature_list)
+    for f in signature_dict:
+      f.EndProduce(signature, run)
+    if not run:
+      self.__done = True
+      return True
 
-    #Run the job.
-    self.__kind.GetRunner(self)()
-    #TODO: We need to do something like this, but this overly agressively saves the cache files (Some will be empty, even though they shouldn't b)
-    #      Really we should just finish all the files?
-    #for f in self.__output_set: #Ensure the caches are commited. Since the files may not be finished, which is when files are guaranteed to have caches finished.
-    #  f.jhm_cache_file.Save()
+    #An identical job may have been run before, in this out tree, another, or on another machine.
+    cache = self.__env.artifact_cache
+    remote = self.__env.remote_cache
+    key = None
+    if (cache or remote) and command_list and self.__kind.IsCacheable(self):
+      key = self.__env.GetArtifactKey(self.__kind, command_list, self.__GetInFileSet())
+    if key is not None and cache:
+      if cache.Restore(key, self.__output_set, self.__env.restat_store is not None):
+        if self.__env.verbose > 0:
+          print 'RESTORED %s' % self
+        self.__done = True
+        return True
+      for f in self.__output_set:
+        cache.Unshare(f.abs_path)
+
+    #Remember what the outputs were, so any the job makes again exactly the same can keep their old stamps.
+    old_output_dict = self.__GetOutputDigests()
+
+    def Finish(command_time):
+      self.__env.SetJobDuration(self, runner_time + command_time)
+      self.__kind.Finish(self)
+      self.__KeepUnchangedStamps(old_output_dict)
+      if key is not None:
+        if cache:
+          cache.Store(key, self.__output_set)
+        if remote:
+          remote.Store(key, self.__output_set)
+      #TODO: We need to do something like this, but this overly agressively saves the cache files (Some will be empty, even though they shouldn't b)
+      #      Really we should just finish all the files?
+      #for f in self.__output_set: #Ensure the caches are commited. Since the files may not be finished, which is when files are guaranteed to have caches finished.
+      #  f.jhm_cache_file.Save()
+      self.__done = True
 
-    self.__done = True
-    self.__env.QueueIfNeeded(self.__output_set)
+    if key is not None and remote:
+      #The builder thread doesn't wait on the server. If it doesn't have the outputs, the commands are run from there.
+      def Fetched(hit):
+        try:
+          if not hit:
+            self.__kind.RunCommands(self, command_list, Finish)
+            return
+          if self.__env.verbose > 0:
+            print 'FETCHED %s' % self
+          if cache:
+            cache.Store(key, self.__output_set)
+          self.__done = True
+        except Exception:
+          self.__env.FinishDeferred(self, sys.exc_info())
+          return
+        self.__env.FinishDeferred(self)
+      remote.Fetch(key, self.__output_set, Fetched)
+      return MultithreadProcessingQueue.DEFERRED
+
+    if command_list:
+      self.__kind.RunCommands(self, command_list, Finish)
+      return MultithreadProcessingQueue.DEFERRED
+
+    Finish(0)
     return True
 
+  def Invalidate(self):
+    """Something the job uses has changed, so it has to be built again."""
+    self.__done = False
+
+  def __GetOutputDigests(self):
+    """Get the (mtime, digest) of each of our outputs which exists, by File."""
+    digests = self.__env.restat_store
+    output_dict = {}
+    if digests is None:
+      return output_dict
+    for f in self.__output_set:
+      st = self.__env.stat_cache.Stat(f.abs_path)
+      digest = digests.Get(f.abs_path) if st else None
+      if digest is not None:
+        output_dict[f] = (st.st_mtime, digest)
+    return output_dict
+
+  def __KeepUnchangedStamps(self, old_output_dict):
+    """Put back the mtime of every output which the job made exactly the same as it was (Like ninja's restat), so what
+    uses it isn't rebuilt just because it was made again."""
+    digests = self.__env.restat_store
+    if digests is None:
+      return
+    for f in self.__output_set:
+      try:
+        digest = HashFile(f.abs_path)
+      except IOError:
+        continue
+      if f in old_output_dict and old_output_dict[f][1] == digest:
+        os.utime(f.abs_path, (time.time(), old_output_dict[f][0]))
+        if self.__env.verbose > 0:
+          print 'UNCHANGED %s' % f
+      #Recorded now, the digest doesn't have to be worked out again the next time the job runs.
+      digests.Set(f.abs_path, digest)
+
+  def __GetInFileSet(self):
+    """Everything the job could read: what it depends on, and everything they require."""
+    in_file_set = set()
+    with self.__dep_lock:
+      to_check = list(self.__depend_set)
+    while to_check:
+      f = to_check.pop()
+      if f not in in_file_set:
+        in_file_set.add(f)
+        to_check += list(f.req_set)
+    return in_file_set
+
   @property
   def depend_set(self):
     return self.__depend_set
@@ -930,6 +2453,23 @@ class Job(object):
 class File(object):
   """A path inside a JHM Tree, may or may not need to be built."""
 
+  #There's a File for every path the graph touches (Including every system header), so they're kept compact: no
+  #__dict__, shared strings for the parts of paths which repeat, locks shared with other Files, and sets (and dicts) only
+  #made once something is put in them.
+  __slots__ = ('__env', '__tree', '__branch', '__base', '__ext_list', '__rel_path', '__name', '__abs_path', '__hash',
+               '__kind', '__prefix', '__atom', '__jhm_cache_file', '__cache_checked', '__cache_finished',
+               '__cached_reqs', '__set_aside_cache', '__signature_pending', '__jhm_file', '__jhm_filename', '__stamp',
+               '__done', '__req_set', '__producer', '__user_tree_lock', '__consumer_set', '__user_set',
+               '__is_available', '__availability_searched', '__section_lock', '__section_dict', '__req_section_dict',
+               '__req_section_gen', '__section_gen', '__config_read')
+
+  #The locks of every File. Neither is held while waiting on a lock of another File.
+  user_tree_locks = LockStripes()
+  section_locks = LockStripes()
+
+  #ext_list -> the list all Files with that ext_list share. They're never changed.
+  ext_list_dict = {}
+
   @staticmethod
   def ToRelPath(branch, base, ext_list):
     """Convert a branch, base, and ext_list to a relative path"""
@@ -943,9 +2483,10 @@ class File(object):
   def __init__(self, tree, branch, base, ext_list, env):
     self.__env = env
     self.__tree = tree
-    self.__branch = Validate(IsRelPath, branch)
+    self.__branch = intern(Validate(IsRelPath, branch))
     self.__base = base
-    self.__ext_list = Validate(IsValidExtList, ext_list)
+    self.__ext_list = File.ext_list_dict.setdefault(tuple(Validate(IsValidExtList, ext_list)),
+                                                    [intern(ext) for ext in ext_list])
     self.__rel_path = File.ToRelPath(self.__branch, base, ext_list)
     self.__name = self.__rel_path[len(branch)+1:-len(ext_list[-1])-1]
     self.__abs_path = tree.GetAbsPath(self.__rel_path)
@@ -956,36 +2497,46 @@ class File(object):
     Validate(IsValidAtom, self.__atom)
 
     #Computed properties/flags.
-    self.__cache_filename = env.out_tree.GetAbsPath(self.__rel_path + '.jhm-cache')
     self.__jhm_cache_file = None
     self.__cache_checked = False
     self.__cache_finished = False
+    self.__cached_reqs = None
+    self.__set_aside_cache = None
+    self.__signature_pending = False
 
     #NOTE: It is a design decision that JHM Files cannot be produced by a job. If you can automatically find the depends/reqs/additional args/etc. you
     #      should be doing so in the FileKind for the file, or JobKinds which use the file.
     self.__jhm_file = None
     self.__jhm_filename = None
     jhm_filename_rel_path = self.__rel_path + '.jhm'
-    for t in self.env.YieldEachInTree():
-      path = t.GetAbsPath(jhm_filename_rel_path)
-      if os.path.exists(path):
-        self.__jhm_filename = path
-        break;
+    t = self.env.FindInTree(jhm_filename_rel_path)
+    if t:
+      self.__jhm_filename = t.GetAbsPath(jhm_filename_rel_path)
     self.__stamp = None
     self.__done = False
 
-    self.__req_set = set()
+    self.__req_set = EMPTY_SET
     self.__producer = None
-    self.__user_tree_lock = threading.RLock()
-    self.__consumer_set = set()
-    self.__user_set = set()
+    self.__user_tree_lock = File.user_tree_locks.Get(self.__hash)
+    self.__consumer_set = EMPTY_SET
+    self.__user_set = EMPTY_SET
 
     self.__is_available = False
     self.__availability_searched = False
 
+    #Resolved config, kept until what it was resolved from changes.
+    self.__section_lock = File.section_locks.Get(self.__hash)
+    self.__section_dict = None      #(section, parent) -> list of (k, v) in our own config
+    self.__req_section_dict = None  #section -> list of (k, v) merged from the config of our req_set
+    self.__req_section_gen = 0    #Bumped whenever __req_section_dict is cleared.
+    self.__section_gen = 0        #Bumped whenever __section_dict is cleared.
+    self.__config_read = False    #Whether our config has been resolved since it last changed.
+
   def AddConsumer(self, consumer):
     """Add a job which depends on this file."""
     with self.__user_tree_lock:
+      if self.__consumer_set is EMPTY_SET:
+        self.__consumer_set = set()
       self.__consumer_set.add(consumer)
       reqs = self.__req_set
     if len(reqs) > 0:
@@ -999,7 +2550,11 @@ class File(object):
 
     with self.__user_tree_lock:
       new_reqs = reqs - self.__req_set - set([self])
+      if new_reqs and self.__req_set is EMPTY_SET:
+        self.__req_set = set()
       self.__req_set |= new_reqs
+      if new_reqs:
+        self.__ForgetReqSections()
       cons = frozenset(self.__consumer_set)
       users = frozenset(self.__user_set)
       #If we are in the source tree, We define our stamp, to be the newest of our requires stamps.
@@ -1021,6 +2576,8 @@ class File(object):
     """Add a file which depends on this file."""
     #Users are files which have this file in their req_set
     with self.__user_tree_lock:
+      if self.__user_set is EMPTY_SET:
+        self.__user_set = set()
       self.__user_set.add(user)
       reqs = self.__req_set
     if len(reqs) > 0:
@@ -1033,38 +2590,18 @@ class File(object):
 
     if self.__cache_finished:
       self.__done = True
-      self.__env.QueueIfNeeded(self.__user_set | self.__consumer_set)
       return True
 
-    #Check cache file to see if there is anything that needs to be done
-    if not (self.__cache_checked or self.__env.force):
-      self.__cache_checked = True
-      cache_timestamp = GetTimestamp(self.__cache_filename)
-
-      def CheckCache():
-        """Open the cache file, check each req timetsamp."""
-        self.__jhm_cache_file = JHMOutFile(self.__cache_filename, True)
-        new_reqs = set()
-        for req, _ in self.__jhm_cache_file.YieldSection('requires'):
-          f = req.strip()
-          if GetTimestamp(f) >= cache_timestamp or not os.path.exists(f):
-            self.__jhm_cache_file = None
-            return False
-          new_reqs.add(f)
-        file_set = set()
-        for f in new_reqs:
-          file_set.add(self.env.GetFileFromPath(f.strip()))
-        for f in file_set:
-          f.__CacheFinish()
-        self.AddReqs(file_set)
-        return True
+    #Check cache file to see if there is anything that needs to be done. If a job makes us, the cache is only good if
+    #the job would still run the same commands, which the job has to work out.
+    self.__CheckCache()
+    if self.__signature_pending and self.__env.Queue(set([self.__producer])):
+      return False
+    if self.__cached_reqs is not None:
+      self.__FinishFromCache()
+      self.__done = True
+      return True
 
-      if (self.__jhm_filename != None and GetTimestamp(self.__jhm_filename) <= self.stamp) or self.__jhm_filename is None:
-        if os.path.isfile(self.__cache_filename) and self.stamp > 0 and cache_timestamp >= self.stamp:
-          if CheckCache():
-            self.__done = True
-            self.__env.QueueIfNeeded(self.__consumer_set | self.__user_set)
-            return True
     if not self.__jhm_cache_file:
       self.FinishNoCache()
 
@@ -1081,27 +2618,148 @@ class File(object):
       return False
 
     #Add reqs to jhm_cachefile and save it since it cannot be changed again.
+    digests = self.__env.digest_store
     for f in self.__req_set:
-      self.jhm_cache_file.Set('requires', f.abs_path)
+      self.jhm_cache_file.Set('requires', f.abs_path, digests.Get(f.abs_path) if digests else None)
+    for f in self.__GetGeneratedFromSet():
+      self.jhm_cache_file.Set('generated-from', f.abs_path, None)
+    if digests:
+      self.jhm_cache_file.Set('digest', 'self', digests.Get(self.__abs_path))
+      if self.__jhm_filename is not None:
+        self.jhm_cache_file.Set('digest', 'jhm', digests.Get(self.__jhm_filename))
     self.jhm_cache_file.Save()
 
-    #TODO: This overly agressively queues items. Really should do a more precise check per item when queuing.
     self.__done = True
-    self.__env.QueueIfNeeded(self.__user_set | self.__consumer_set)
     return True
 
+  def Invalidate(self):
+    """This file (or something it requires) has changed, so forget everything found out about it while building it."""
+    with self.__user_tree_lock:
+      self.__done = False
+      self.__cache_checked = False
+      self.__cache_finished = False
+      self.__cached_reqs = None
+      self.__set_aside_cache = None
+      self.__signature_pending = False
+      self.__jhm_file = None
+      self.__SetCacheFile(None)
+      self.__stamp = None
+
+  def __CheckCache(self):
+    """Check (once) whether our cache is fresh. If it is, the requires it lists are kept until we finish from it."""
+    with self.__user_tree_lock:
+      if self.__cache_checked or self.__env.force:
+        return
+      self.__cache_checked = True
+      cache_timestamp = self.__env.cache_store.GetStamp(self.__rel_path)
+
+      digests = self.__env.digest_store
+
+      def IsFresh(path, digest):
+        """Whether the given path is unchanged since the cache file was written, when it had the given digest."""
+        if digests:
+          return digest is not None and digests.Get(path) == digest
+        st = self.__env.stat_cache.Stat(path)
+        return st is not None and st.st_mtime < cache_timestamp
+
+      def CheckCache():
+        """Open the cache file, check each req is fresh."""
+        self.__SetCacheFile(self.__env.cache_store.Open(self.__rel_path, True))
+        if digests:
+          #We're only fresh if we (and our jhm file) also have the same digest as when the cache was written.
+          if not IsFresh(self.__abs_path, self.__jhm_cache_file.Get('self', 'digest')) or (self.__jhm_filename is not None
+              and not IsFresh(self.__jhm_filename, self.__jhm_cache_file.Get('jhm', 'digest'))):
+            self.__SetCacheFile(None)
+            return False
+        new_reqs = set()
+        generated_from = set()
+        if self.__producer is not None:
+          generated_from = set(path.strip() for path, _ in self.__jhm_cache_file.YieldSection('generated-from'))
+        for req, digest in self.__jhm_cache_file.YieldSection('requires'):
+          f = req.strip()
+          if f not in generated_from and not IsFresh(f, digest):
+            self.__SetCacheFile(None)
+            return False
+          new_reqs.add(f)
+        self.__cached_reqs = new_reqs
+        self.__signature_pending = self.__producer is not None
+        return True
+
+      if digests:
+        if cache_timestamp > 0:
+          CheckCache()
+      elif (self.__jhm_filename != None and self.__env.stat_cache.GetTimestamp(self.__jhm_filename) <= self.stamp) or self.__jhm_filename is None:
+        if cache_timestamp > 0 and self.stamp > 0 and cache_timestamp >= self.stamp:
+          CheckCache()
+
+  def __GetGeneratedFromSet(self):
+    """Get the requires which other requires are made from by a job. Whether they changed is told by whether what was
+    made from them did, so an output made again exactly the same (which keeps its stamp) doesn't make us out of date.
+
+    Only for files with a producer, since their cache is checked again once everything they require has been built."""
+    generated_from = set()
+    if self.__producer is None:
+      return generated_from
+    for f in self.__req_set:
+      if f.producer is not None and f.producer.input is not None and f.producer is not self.__producer:
+        generated_from.add(f.producer.input)
+    return generated_from & self.__req_set
+
+  def __FinishFromCache(self):
+    """Take our requires from our (fresh) cache, rather than scanning for them."""
+    file_set = set()
+    for f in self.__cached_reqs:
+      file_set.add(self.env.GetFileFromPath(f))
+    self.__cached_reqs = None
+    for f in file_set:
+      f.__CacheFinish()
+    self.AddReqs(file_set)
+
+  def BeginProduce(self):
+    """Called by our producer before it works out what to run. Returns the command signature of our cache if it is still
+    fresh (None if it isn't), or False if we're already finished.
+
+    Until EndProduce, our cache is set aside, and the producer gets an empty one to add flags to."""
+    with self.__user_tree_lock:
+      if self.__done or self.__cache_finished:
+        return False
+      #What we require may have been rebuilt since we first looked at our cache, so look again.
+      self.__cache_checked = False
+      self.__cached_reqs = None
+      self.__SetCacheFile(None)
+      self.__CheckCache()
+      signature = None
+      if self.__cached_reqs is not None:
+        signature = self.__jhm_cache_file.Get('signature', 'command')
+      self.__set_aside_cache = self.__jhm_cache_file
+      self.__SetCacheFile(self.__env.cache_store.Open(self.__rel_path, False))
+      return signature
+
+  def EndProduce(self, signature, run):
+    """Called by our producer once it knows whether it is going to run the commands with the given signature. If it
+    isn't, our old cache is still good. If we had none, the new one is started with the signature."""
+    with self.__user_tree_lock:
+      if run or self.__set_aside_cache is None:
+        self.__cached_reqs = None
+        self.__jhm_cache_file.Set('command', 'signature', signature)
+      else:
+        self.__SetCacheFile(self.__set_aside_cache)
+      self.__set_aside_cache = None
+      self.__signature_pending = False
+
   def FinishNoCache(self):
     if self.__jhm_cache_file is None:
-      self.__jhm_cache_file = JHMOutFile(self.__cache_filename, False)
+      self.__SetCacheFile(self.__env.cache_store.Open(self.__rel_path, False))
 
   def __CacheFinish(self):
     #This function is so the file can get itself to a good state if it is finished by another file's cache.
     #TODO: This function has a race condition with regular completion.
-    if self.__done or self.__jhm_cache_file:
+    #Files a job makes are only finished from their own cache, once their producer has said its commands are the same.
+    if self.__done or self.__jhm_cache_file or self.__producer is not None:
       return
     self.__cache_finished = True
     if not self.__jhm_cache_file:
-      self.__jhm_cache_file = JHMOutFile(self.__cache_filename, True)
+      self.__SetCacheFile(self.__env.cache_store.Open(self.__rel_path, True))
     self.AddReqs(set(map(lambda v: self.env.GetFileFromPath(v[0].strip()), self.__jhm_cache_file.YieldSection('requires'))))
 
   def FindAvailability(self):
@@ -1163,36 +2821,80 @@ class File(object):
 
   def HasInConfig(self, section, key, needed_value=None):
     """Returns whether the key exists with the given value."""
-    #TODO: Could be more efficent about this.
-    for k, v in JHMFile.MergeAndYieldSection(list(self.__req_set) + [self], section):
-      if k == key:
-        if needed_value is None:
-          return True
-        if needed_value == v:
-          return True
-    return False
+    #Our requires take precedence over us.
+    merged = dict(self.YieldSection(section))
+    merged.update(self.YieldReqSection(section))
+    if key not in merged:
+      return False
+    return needed_value is None or needed_value == merged[key]
 
 
   def YieldParentSection(self, section=''):
     """Yield a section from this files parents config"""
-    for k, v in JHMFile.MergeAndYieldSection(self.__env.sys_config_list, section): yield k, v
+    return self.__env.YieldConfigSection(section)
 
   def YieldReqSection(self, section=''):
     """Yield a section from this files requires config."""
-    for k, v in JHMFile.MergeAndYieldSection(list(self.__req_set), section): yield k, v
+    items = self.__req_section_dict and self.__req_section_dict.get(section)
+    if items is None:
+      gen = self.__req_section_gen
+      items = list(JHMFile.MergeAndYieldSection(list(self.__req_set), section))
+      with self.__section_lock:
+        #If something changed while we were merging, what we got may already be out of date.
+        if gen == self.__req_section_gen:
+          if self.__req_section_dict is None:
+            self.__req_section_dict = {}
+          self.__req_section_dict[section] = items
+    return iter(items)
 
   def YieldSection(self, section='', parent=False):
     """Yield a section from this file's config (The JHM File for this file, followed by the system configuration)."""
-
-    conf_list = []
-    if self.jhm_file: conf_list.append(self.jhm_file)
-
-    if self.done or self.__jhm_cache_file:
-      conf_list.append(self.__jhm_cache_file)
-
-    if parent: conf_list += self.__env.sys_config_list
-
-    for k, v in JHMFile.MergeAndYieldSection(conf_list, section): yield k, v
+    key = (section, parent)
+    items = self.__section_dict and self.__section_dict.get(key)
+    if items is None:
+      #Set before reading, so a change made while we're reading is sure to be passed on.
+      self.__config_read = True
+      gen = self.__section_gen
+      conf_list = []
+      if self.jhm_file: conf_list.append(self.jhm_file)
+
+      if self.done or self.__jhm_cache_file:
+        conf_list.append(self.__jhm_cache_file)
+
+      if parent: conf_list += self.__env.sys_config_list
+
+      items = list(JHMFile.MergeAndYieldSection(conf_list, section))
+      with self.__section_lock:
+        #If something changed while we were reading, what we got may already be out of date.
+        if gen == self.__section_gen:
+          if self.__section_dict is None:
+            self.__section_dict = {}
+          self.__section_dict[key] = items
+    return iter(items)
+
+  def __SetCacheFile(self, jhm_cache_file):
+    """Switch to another cache file (or None), and find out whenever its settings change."""
+    self.__jhm_cache_file = jhm_cache_file
+    if jhm_cache_file is not None:
+      jhm_cache_file.on_change = self.__ConfigChanged
+    self.__ConfigChanged()
+
+  def __ConfigChanged(self):
+    """Our own config changed, so forget it, along with the merged config of everything which requires us."""
+    #Nothing has been resolved from our config since it last changed, so there's nothing to forget.
+    if not self.__config_read:
+      return
+    with self.__section_lock:
+      self.__config_read = False
+      self.__section_dict = None
+      self.__section_gen += 1
+    for user in frozenset(self.__user_set):
+      user.__ForgetReqSections()
+
+  def __ForgetReqSections(self):
+    with self.__section_lock:
+      self.__req_section_dict = None
+      self.__req_section_gen += 1
 
   def __Scan(self):
     """Scan the file for dependencies."""
@@ -1216,6 +2918,11 @@ class File(object):
   def branch(self):
     return self.__branch
 
+  @property
+  def cache_saved(self):
+    """Whether our cache has ever been saved."""
+    return self.__env.cache_store.GetStamp(self.__rel_path) > 0
+
   @property
   def consumer_set(self):
     return self.__consumer_set
@@ -1250,12 +2957,23 @@ class File(object):
   def is_available(self):
     return self.__is_available
 
+  @property
+  def user_set(self):
+    """Files which have this file in their req_set."""
+    return self.__user_set
+
+  @property
+  def jhm_filename(self):
+    """Absolute path to the .jhm file for this file, or None if it doesn't have one."""
+    return self.__jhm_filename
+
   @property
   def jhm_file(self):
     if self.__jhm_file is None:
       self.__jhm_file = False
       if self.__jhm_filename is not None:
-        self.__jhm_file = JHMFile(self.__jhm_filename)
+        self.__jhm_file = LoadJHMFile(self.__jhm_filename)
+        self.__ConfigChanged()
         self.AddReqs(set(map(lambda k: self.env.GetFileFromPath(k[0]), self.__jhm_file.YieldSection('requires'))))
     return self.__jhm_file
 
@@ -1292,7 +3010,7 @@ class File(object):
   @property
   def stamp(self):
     if self.__stamp is None:
-      self.__stamp = GetTimestamp(self.__abs_path)
+      self.__stamp = self.__env.stat_cache.GetTimestamp(self.__abs_path)
     return self.__stamp
 
   @property
@@ -1308,6 +3026,103 @@ class File(object):
   def __repr__(self):
     return str(self)
 
+class InotifyWatcher(object):
+  """Waits for changes to the files in a set of directories using Linux's inotify (through ctypes)."""
+
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+
+  WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+  #Seconds to keep gathering changes after the first one, since saving a file is often several changes.
+  SETTLE_TIME = 0.1
+
+  def __init__(self):
+    try:
+      self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      self.__fd = self.__libc.inotify_init()
+    except (OSError, AttributeError):
+      raise BuildError('Watching for changes needs inotify, which is only available on Linux.')
+    if self.__fd < 0:
+      raise BuildError('Unable to start watching for changes: %s' % os.strerror(ctypes.get_errno()))
+    SetCloseOnExec(self.__fd)
+    self.__path_by_wd = {}
+    self.__watched_set = set()
+
+  def Read(self, timeout=None):
+    """Wait for changes, for at most timeout seconds (forever if None). Returns the set of paths which changed (empty if
+    none did in time), or None if too many changed to keep track of."""
+    path_set = set()
+    while True:
+      ready, _, _ = select.select([self.__fd], [], [], timeout)
+      if not ready:
+        return path_set
+      data = os.read(self.__fd, 65536)
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+        name = data[offset + 16:offset + 16 + length].rstrip('\0')
+        offset += 16 + length
+        if mask & InotifyWatcher.IN_Q_OVERFLOW:
+          return None
+        if wd in self.__path_by_wd and name:
+          path_set.add(os.path.join(self.__path_by_wd[wd], name))
+      if path_set:
+        timeout = InotifyWatcher.SETTLE_TIME
+
+  def Watch(self, path):
+    """Start watching the directory at path, if it isn't already."""
+    if path in self.__watched_set:
+      return
+    wd = self.__libc.inotify_add_watch(self.__fd, path, InotifyWatcher.WATCH_MASK)
+    if wd < 0:
+      raise BuildError('Unable to watch "%s" for changes: %s' % (path, os.strerror(ctypes.get_errno())))
+    self.__path_by_wd[wd] = path
+    self.__watched_set.add(path)
+
+def Watch(make_env):
+  """Build the targets of the Env make_env returns, then build them again whenever something they need changes. Runs
+  until interrupted.
+
+  The Env (and its Files and Jobs) are kept between builds, and only the Files which changed and what was built from
+  them are checked again. Changes the Env can't take in (see Env.Invalidate) make a new Env with make_env instead."""
+  watcher = InotifyWatcher()
+  watched = False
+  env = None
+  while True:
+    try:
+      if env is None:
+        env = make_env()
+        env.Build()
+      else:
+        env.Rebuild()
+    except BuildError as e:
+      print 'Build Error:', e
+      #Without an Env, we don't know what to watch unless there was one before.
+      if env is None and not watched:
+        raise
+    if env is not None:
+      watched = True
+      for path in env.GetWatchPaths():
+        watcher.Watch(path)
+    print 'Waiting for changes...'
+
+    while True:
+      path_set = watcher.Read()
+      if env is None:
+        break
+      changed = env.Invalidate(path_set) if path_set is not None else False
+      if changed is False:
+        env = None
+      if changed is not None:
+        break
+
 def TryFindRoot(dirname):
   path = os.getcwd()
   while path:
@@ -1322,6 +3137,10 @@ def TryFindRoot(dirname):
 class Env(object):
   """A build environment, containing trees and files, files which are interconnected by jobs, dependencies, and requires."""
 
+  #Options which don't change what is built, so don't invalidate the graph snapshot.
+  SNAPSHOT_IGNORED_OPTIONS = set(['targets', 'exec_targets', 'verbose', 'jhm_debug', 'keep_going', 'num_cores', 'num_procs',
+                                  'print_all_cmd', 'print_build_cmd', 'no_graph_snapshot', 'no_server'])
+
   def __init__(self, options):
     #Options is a namespace (most likely built by argparse), containing JHM options.
     self.__options = options
@@ -1338,6 +3157,7 @@ class Env(object):
     self.__config['project'] = GetConfig(options.project_conf_root, os.path.join(self.__root, '.jhm'))
     self.__config['user'] = GetConfig(options.user_conf_root, os.path.expanduser('~/.jhm'))
     self.__config['sys'] = GetConfig(options.sys_conf_root, '/etc/jhm')
+    self.__config_section_dict = {}  #Section -> list of (k, v) merged from all the configs
 
     def ProjectAbs(path):
       if not os.path.isabs(path):
@@ -1354,6 +3174,11 @@ class Env(object):
       out_sub_dir +=  '-' + options.arch
     self.__out_tree = Tree(Tree.OUT, ProjectAbs(options.out_dir if options.out_dir else os.path.join(self.__config['project'].Get('out_dir', default='out'),out_sub_dir)))
 
+    #Everything but the output tree is assumed not to change during a build, so stats and directory listings of it can be
+    #shared.
+    self.__stat_cache = StatCache([self.__out_tree.path])
+    self.__closure_index = ClosureIndex()
+
     #Setup file kinds for easy access.
     self.__file_kinds = list(chain(self.__config['project'].file_kinds, self.__config['user'].file_kinds, self.__config['sys'].file_kinds))
     self.__file_kinds_by_ext = {}
@@ -1374,7 +3199,7 @@ class Env(object):
 
     #Load in the targets.
     #TODO #HACK: We do '1:' here to slice off the program name. This should really be done by argparse.
-    self.__targets = set(options.targets[1:] if options.targets[1:] else (filter(lambda x: x, map(lambda s: s.strip(), [] if options.no_auto_targets else list(k for k, v in self.YieldConfigSection('targets'))))))
+    self.__targets = self.__GetTargetPaths(options)
     self.__file_dict = {}
     self.__job_dict = {}
     self.__file_lock = threading.RLock()
@@ -1393,24 +3218,28 @@ class Env(object):
         with print_lock:
           print ('TRY FINISH %s' % self.__file_dict[item[1]] if item[0] == 'F' else 'TRY BUILD %s' % self.__job_dict[item[1]])
 
-      if item[0] == 'F':
-        i = self.__file_dict[item[1]]
-      elif item[0] == 'J':
-        i = self.__job_dict[item[1]]
-      else:
-        #Serious error. Completely invalid type entered.
-        assert(False)
+      i = self.__GetQueueItem(item)
 
       result = i.Build()
-      if result:
+      if result is True:
         i.done = True
 
       if self.verbose > 0:
         with print_lock:
-          if result:
+          if result is True:
             print('FINISHED: %s' % i if item[0] == 'F' else 'BUILT %s' % i)
+          elif result is MultithreadProcessingQueue.DEFERRED:
+            print('RUNNING %s' % i)
       return result
 
+    def ItemCost(item):
+      """Estimated cost of processing a queue item. Only jobs take any real amount of time."""
+      return self.GetJobDuration(self.__job_dict[item[1]]) if item[0] == 'J' else 0
+
+    def ItemResources(item):
+      """Resources needed to process a queue item. Only jobs use any."""
+      return self.__job_resource_dict[self.__job_dict[item[1]].kind] if item[0] == 'J' else {}
+
     def ItemToHashable(item):
       if isinstance(item, File):
         return ('F', hash(item))
@@ -1420,13 +3249,98 @@ class Env(object):
         #Serious error. We only build files and jobs...
         assert(False)
 
-    self.__queue = MultithreadProcessingQueue(QueueWorker, ItemToHashable, self.__num_cores, options.jhm_debug)
+    #How long jobs took in previous builds, by job kind and output. Jobs which haven't been run yet are assumed to take as
+    #long as the average job of the same kind.
+    self.__duration_file = JHMOutFile(self.__out_tree.GetAbsPath('.jhm-durations'), True)
+    self.__duration_lock = threading.Lock()
+    self.__duration_changed = False
+    self.__kind_duration_dict = {}
+    for section, durations in self.__duration_file.settings_by_section.items():
+      if durations:
+        self.__kind_duration_dict[section] = sum(float(v) for v in durations.values()) / len(durations)
+
+    #How much of each named resource there is to go around (Ex. link=2, memory=16G). Job kinds say how much they need,
+    #which can be overridden by job kind name in the job-resources config section (Ex. link=link,memory=4G).
+    self.__capacity_dict = dict((k, ParseAmount(v)) for k, v in self.YieldConfigSection('resources'))
+    self.__capacity_dict.update(ParseResources(','.join(options.resources)))
+    job_resource_config = dict(self.YieldConfigSection('job-resources'))
+    self.__job_resource_dict = {}
+    for job_kind in self.__job_kinds:
+      if job_kind.name in job_resource_config:
+        self.__job_resource_dict[job_kind] = ParseResources(job_resource_config[job_kind.name])
+      else:
+        self.__job_resource_dict[job_kind] = job_kind.resources
+
+    self.__queue = MultithreadProcessingQueue(QueueWorker, ItemToHashable, self.__num_cores, options.jhm_debug, ItemCost,
+                                              ItemResources, self.__capacity_dict, options.keep_going)
 
 
+    #Where the caches of Files are kept. Either a single log for the whole output tree, or a file for each File.
+    cache_store = options.cache_store if options.cache_store is not None else self.GetConfig('cache_store', default='log')
+    if cache_store == 'log':
+      self.__cache_store = LogCacheStore(self.__out_tree.GetAbsPath('.jhm-cache-log'), background_writer)
+    elif cache_store == 'file':
+      self.__cache_store = FileCacheStore(self.__out_tree, background_writer)
+    else:
+      raise BuildError('Invalid cache store "%s". The cache store must be "log" or "file"' % cache_store)
+
+    #In digest mode, files are out of date when their contents change rather than whenever they are touched.
+    #The artifact caches need digests as well, whether or not we're in digest mode.
+    digest_mode = options.digest or ParseBool(self.GetConfig('digest', default='no'))
+    artifact_cache = options.artifact_cache or self.GetConfig('artifact_cache')
+    remote_cache = options.remote_cache or self.GetConfig('remote_cache')
+    #Outputs which are made again exactly the same keep their old stamp, which also needs their digests.
+    restat = not options.no_restat
+    self.__digests = None
+    if digest_mode or artifact_cache or remote_cache or restat:
+      self.__digests = DigestStore(self.__out_tree.GetAbsPath('.jhm-digests'), self.__stat_cache)
+    self.__digest_store = self.__digests if digest_mode else None
+    self.__restat_store = self.__digests if restat else None
+
+    #Outputs of jobs can be kept in a cache shared by several out trees and checkouts, keyed by what the job reads, and
+    #in one on a server shared by many machines.
+    #Paths in the out tree are never baked into what jobs make, but paths in the source tree may be (Ex. in debug info,
+    #or SRC_ROOT), so sharing between checkouts has to be asked for.
+    self.__relocate_list = [(self.__out_tree.path, '$OUT/')]
+    if ParseBool(self.GetConfig('artifact_cache_relocate_root', default='no')):
+      self.__relocate_list.append((os.path.join(self.__root, ''), '$ROOT/'))
+    self.__artifact_cache = None
+    if artifact_cache:
+      artifact_cache_size = ParseAmount(options.artifact_cache_size or self.GetConfig('artifact_cache_size', default='5G'))
+      self.__artifact_cache = ArtifactCache(os.path.abspath(os.path.expanduser(artifact_cache)), artifact_cache_size,
+                                            int(self.GetConfig('artifact_cache_threads', default=2)))
+    self.__remote_cache = None
+    if remote_cache:
+      self.__remote_cache = RemoteArtifactCache(remote_cache, int(self.GetConfig('remote_cache_threads', default=4)))
+
+    #Commands are run by a separate pool of process slots, so the builder threads are only ever busy with the graph.
+    self.__num_procs = options.num_procs if options.num_procs is not None else int(self.GetSysConfig('num_procs', default=self.__num_cores))
+    if self.__num_procs <= 0:
+      raise ValueError('num_procs argument must be greater than zero')
+    self.__executor = CommandExecutor(self.__num_procs)
+    self.__command_local = threading.local()
+
     if self.__verbose > 0:
       print 'FILE KINDS: %s' % ', '.join(repr(str(f)) for f in self.__file_kinds)
       print 'JOB KINDS: %s' % ', '.join(repr(str(f)) for f in self.__job_kinds)
       print 'TREES: %s' % ', '.join(repr(f) for f in self.YieldEachTree())
+      print 'RESOURCES: %s' % ', '.join('%s=%g' % (k, v) for k, v in sorted(self.__capacity_dict.items()))
+
+    #Targets which were built before, and for which nothing has changed, are skipped. Only options which can change
+    #what gets built matter to the snapshot.
+    fingerprint = json.dumps(sorted((k, v) for k, v in vars(options).items() if k not in Env.SNAPSHOT_IGNORED_OPTIONS))
+    config_path_list = []
+    for config in self.__config.values():
+      config_path_list.append(config.conf_root)
+      if os.path.isdir(config.conf_root):
+        config_path_list += [os.path.join(config.conf_root, name) for name in os.listdir(config.conf_root) if not name.endswith('.pyc')]
+    jhm_dir = os.path.dirname(os.path.abspath(__file__))
+    config_path_list += [os.path.join(jhm_dir, name) for name in os.listdir(jhm_dir) if name.endswith('.py')]
+    #Several configs can share a conf root (Ex. an empty one), which the snapshot only keeps once.
+    self.__graph_snapshot = GraphSnapshot(self.__out_tree.GetAbsPath('.jhm-graph'), self.__stat_cache, fingerprint,
+                                          sorted(set(config_path_list)))
+    self.__use_graph_snapshot = not (options.force or options.no_graph_snapshot or options.watch)
+    self.__skipped_target_set = set()
 
     if not self.__file_kinds:
       raise BuildError('No file kinds were found')
@@ -1438,6 +3352,10 @@ class Env(object):
     for path in self.__targets:
       self.AddTargetByPath(path)
 
+  def __GetTargetPaths(self, options):
+    """Get the paths of the targets given in options, or the ones in the config if there aren't any."""
+    return set(options.targets[1:] if options.targets[1:] else (filter(lambda x: x, map(lambda s: s.strip(), [] if options.no_auto_targets else list(k for k, v in self.YieldConfigSection('targets'))))))
+
   def AddTargetByPath(self, path):
     """Adds the given path to the JHM build set."""
     #If starts with a '/' then it is relative to the project root. No one uses absolute absolute paths.
@@ -1454,14 +3372,13 @@ class Env(object):
   def AddTarget(self, f):
     """Adds the given JHM File to the build set."""
     assert isinstance(f, File)
-    self.__target_file_set.add(f)
-    return self.Queue(set([f]))
+    return self.AddTargets(set([f]))
 
   def AddTargets(self, file_set):
     """"Add a set of targets to the build set."""
     assert isinstance(file_set, (set, frozenset))
     self.__target_file_set |= file_set
-    return self.Queue(file_set)
+    return self.__queue.AddRequired(file_set, False)
 
   def Build(self):
     """Build all files that need building in the target set (self.__targets). Raises errors if one or more can't be built."""
@@ -1473,21 +3390,166 @@ class Env(object):
     if self.verbose > 0:
       print "TARGET SET:" + (' '.join(str(f) for f in self.__target_file_set))
 
+    #If nothing any of the targets needed has changed since they were built, none of the graph has to be. Otherwise
+    #they're all built as usual, since a target skipped without its part of the graph has no requires, which the other
+    #targets (and the snapshot of what they needed) would miss.
+    if self.__use_graph_snapshot and all(self.__graph_snapshot.IsClean(f.rel_path) for f in self.__target_file_set):
+      self.__queue.Reset()
+      for f in self.__target_file_set:
+        f.done = True
+      self.__skipped_target_set = set(self.__target_file_set)
+
     #Run the job queue and wait for it to coalesce
     with self.__queue:
       pass
 
+    if self.verbose > 0:
+      print 'STAT CACHE: %s' % self.__stat_cache
+
+    #If something failed, let any commands which are still running finish before we give up. Outputs still being
+    #uploaded to the remote cache, or stored in the artifact cache (Which their commands finishing can start), are worth
+    #waiting for too.
+    if self.__remote_cache:
+      self.__remote_cache.Wait()
+    self.__executor.Stop()
+    if self.__artifact_cache:
+      self.__artifact_cache.Wait()
+    self.SaveJobDurations()
+    self.__cache_store.Flush()
+    if self.__digests:
+      self.__digests.Save()
+    if self.__artifact_cache:
+      if self.verbose > 0:
+        print 'ARTIFACT CACHE: %s' % self.__artifact_cache
+      self.__artifact_cache.Trim()
+    if self.__remote_cache and self.verbose > 0:
+      print 'REMOTE CACHE: %s' % self.__remote_cache
+
     #If one of the workers died, then we have a build error that not everything was finished.
     if self.__queue.worker_dead:
       raise BuildError('One (or more) jobs exited with an error code.')
 
+    #When keeping going, everything which could be built was. Summarize everything that couldn't.
+    failed_dict = self.__queue.failed_dict
+    if failed_dict:
+      failures = sorted('  %s: %s' % (self.__GetQueueItem(k), str(e).split('\n', 1)[0]) for k, e in failed_dict.items())
+      raise BuildError('%s item(s) failed:\n%s\n%s item(s) were not built because something they need failed.'
+                         % (len(failures), '\n'.join(failures), len(self.__queue.stalled_set)))
+
     leftovers = filter(lambda x: not x.done, self.__target_file_set)
     if leftovers:
       raise BuildError('LEFTOVERS:\n%s\nCRITICAL JHM BUILD FAILURE. EXITED WITHOUT FINISHING EVERYTHING. Note if you just re-run jhm, everything will likely work.' % leftovers)
 
+    #Everything was built, so remember what each target needed for next time.
+    if self.verbose > 0 and self.__skipped_target_set:
+      print 'UNCHANGED SINCE LAST BUILT: %s' % ' '.join(str(f) for f in self.__skipped_target_set)
+    for f in self.__target_file_set - self.__skipped_target_set:
+      self.__graph_snapshot.Record(f.rel_path, self.__GetSnapshotPaths(f))
+    self.__graph_snapshot.Save()
+
     if self.options.exec_targets:
       self.Exec()
 
+  def __GetSnapshotPaths(self, target):
+    """Get the paths of everything the target was built from, and the directories they're in, for the graph snapshot."""
+    path_set = set()
+    file_set = set()
+    to_check = [target]
+    while to_check:
+      f = to_check.pop()
+      if f in file_set:
+        continue
+      file_set.add(f)
+      path_set.add(f.abs_path)
+      if f.jhm_filename is not None:
+        path_set.add(f.jhm_filename)
+      for t in self.YieldEachInTree():
+        path_set.add(t.GetAbsPath(f.branch))
+      to_check += list(f.req_set)
+      if f.producer:
+        to_check += list(f.producer.depend_set)
+    return path_set
+
+  def Rebuild(self):
+    """Build the targets again, after something they need has been invalidated."""
+    self.__queue.Reset()
+    self.__queue.AddRequired(self.__target_file_set, False)
+    self.Build()
+
+  def Retarget(self, options):
+    """Build the targets in options instead on the next Rebuild. Everything else in options should match what the Env
+    was made with, since most options are only looked at when it is made."""
+    self.__options = options
+    self.__queue.Reset()
+    self.__targets = self.__GetTargetPaths(options)
+    self.__target_file_set = set()
+    self.__skipped_target_set = set()
+    for path in self.__targets:
+      self.AddTargetByPath(path)
+
+  def Invalidate(self, path_set):
+    """Forget everything found out about Files at the given (changed) paths, and everything built from them.
+
+    Returns None if none of the paths matter to the build, True if Rebuild will take in the changes, and False if a
+    new Env is needed (Ex. the config changed, or files appeared or disappeared, which can change how things are found).
+    """
+    config_root_set = set(os.path.normpath(c.conf_root) for c in self.__config.values())
+    file_by_path = {}
+    for f in self.__file_dict.values():
+      if f.tree.kind != Tree.OUT:
+        file_by_path[f.abs_path] = f
+        if f.jhm_filename is not None:
+          file_by_path[f.jhm_filename] = f
+
+    changed_set = set()
+    for path in path_set:
+      if os.path.dirname(path) in config_root_set:
+        if not path.endswith('.pyc'):
+          return False
+        continue
+      f = file_by_path.get(path)
+      exists = os.path.exists(path)
+      if f is not None:
+        if not exists:
+          return False
+        changed_set.add(f)
+      elif exists and (path.endswith('.jhm') or self.GetFileKindsWithExt(os.path.splitext(path)[1][1:])):
+        return False
+    if not changed_set:
+      return None
+
+    self.__stat_cache.Forget(path_set)
+    to_invalidate = list(changed_set)
+    invalid_set = set()
+    while to_invalidate:
+      i = to_invalidate.pop()
+      if i in invalid_set:
+        continue
+      invalid_set.add(i)
+      i.Invalidate()
+      if isinstance(i, File):
+        to_invalidate += list(i.user_set) + list(i.consumer_set)
+        #Requires found by running the producer (Ex. from a depfile) don't make the producer's input a user.
+        if i.producer is not None:
+          to_invalidate.append(i.producer)
+      else:
+        to_invalidate += list(i.output_set)
+    self.__closure_index.Forget(invalid_set)
+    if self.verbose > 0:
+      print 'CHANGED: %s (%d files and jobs to check again)' % (' '.join(str(f) for f in changed_set), len(invalid_set))
+    return True
+
+  def GetWatchPaths(self):
+    """Get the directories changes in which can affect the build: the config directories, and the directories in each
+    input tree for the branch of every File not in the output tree."""
+    path_set = set(c.conf_root for c in self.__config.values() if os.path.isdir(c.conf_root))
+    for branch in set(f.branch for f in self.__file_dict.values() if f.tree.kind != Tree.OUT):
+      for t in self.YieldEachInTree():
+        path = t.GetAbsPath(branch)
+        if os.path.isdir(path):
+          path_set.add(os.path.normpath(path))
+    return path_set
+
   def Exec(self):
     """Run all executable targets."""
     for f in self.__target_file_set:
@@ -1499,16 +3561,106 @@ class Env(object):
     return 0
 
 
+  def CollectCommands(self, func):
+    """Call func, collecting the build commands it runs instead of running them. Returns the list of commands collected.
+
+    Commands which the caller needs the output of are still run immediately."""
+    self.__command_local.command_list = []
+    try:
+      func()
+      return self.__command_local.command_list
+    finally:
+      self.__command_local.command_list = None
+
   def RunCmd(self, args, returned_output=False, print_command=False):
-    return RunCmd(args, returned_output, print_command | self.options.print_all_cmd)
+    print_command |= self.options.print_all_cmd
+    command_list = getattr(self.__command_local, 'command_list', None)
+    if command_list is not None and not returned_output:
+      command_list.append((args, print_command))
+      return
+
+    if print_command:
+      print ' '.join(args)
+    returncode, output = self.__executor.Run(args)
+    CheckCmdResult(args, returncode, output, print_command)
+    if returned_output:
+      return output
+
+  def RunDeferred(self, item, command_list, on_success):
+    """Run the (args, print_command) commands in command_list one after another without waiting for them.
+
+    Once they've all finished, on_success is called with the number of seconds they took, and the item is finished in
+    the queue. on_success is called from a builder thread, so whatever it does (Ex. hashing outputs) doesn't hold up
+    the command executor. A failure of any command is a build error for the item."""
+    remaining = collections.deque(command_list)
+    elapsed_list = []
+
+    def RunNext():
+      args, print_command = remaining.popleft()
+
+      def Finished(elapsed, exc_info):
+        try:
+          if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+          elapsed_list.append(elapsed)
+          if remaining:
+            RunNext()
+            return
+        except Exception:
+          self.__queue.FinishDeferred(item, sys.exc_info())
+          return
+        self.ResumeDeferred(item, on_success, sum(elapsed_list))
+
+      self.SubmitCmd(args, print_command, Finished)
+    RunNext()
+
+  def SubmitCmd(self, args, print_command, callback):
+    """Run a build command without waiting for it. Once it has finished, callback is called (from another thread) with
+    the number of seconds it ran for, and the exc_info of why it failed (None if it didn't)."""
+    if print_command:
+      print ' '.join(args)
+
+    def Finished(args, returncode, output, elapsed, exc_info):
+      if not exc_info:
+        try:
+          CheckCmdResult(args, returncode, output, print_command)
+        except Exception:
+          exc_info = sys.exc_info()
+      callback(elapsed, exc_info)
+
+    self.__executor.Submit(args, Finished)
+
+  def FinishDeferred(self, item, exc_info=None):
+    """Finish an item whose Build returned MultithreadProcessingQueue.DEFERRED. If exc_info is given, it failed."""
+    self.__queue.FinishDeferred(item, exc_info)
+
+  def ResumeDeferred(self, item, on_success, *args):
+    """Finish an item whose Build returned MultithreadProcessingQueue.DEFERRED on a builder thread, once on_success
+    has been called there with args. If on_success raises, the item failed."""
+    def Resumed():
+      on_success(*args)
+      return True
+    self.__queue.Resume(item, Resumed)
 
   def RunBuildCmd(self, args, returned_output=False):
     return self.RunCmd(args, returned_output, self.options.print_build_cmd)
 
 
-  def TryFindTree(self, path):
+  def FindInTree(self, rel_path):
+    """Find the first input tree (in order of precedence) which contains the given rel_path. None if none do."""
     for t in self.YieldEachInTree():
-      if t.Contains(path):
+      if self.__stat_cache.Exists(t.GetAbsPath(rel_path)):
+        return t
+    return None
+
+  def TryFindTree(self, path):
+    if IsAbsPath(path):
+      for t in self.YieldEachInTree():
+        if t.ContainsAbs(path):
+          return t
+    else:
+      t = self.FindInTree(path)
+      if t:
         return t
     if self.__out_tree.Contains(path) or not os.path.isabs(path):
       return self.__out_tree
@@ -1521,6 +3673,16 @@ class Env(object):
       raise BuildError('No tree contains the path %s' % path)
     return t
 
+  def GetOtherTreePath(self, path):
+    """Get the path in the output tree matching a path in the source tree, or the other way around."""
+    tree = self.FindTree(path)
+    rel_path = tree.GetRelPath(path)
+    if tree is self.__src_tree:
+      return self.__out_tree.GetAbsPath(rel_path)
+    elif tree is self.__out_tree:
+      return self.__src_tree.GetAbsPath(rel_path)
+    raise ValueError("Not in SRC or OUT tree.")
+
   def GetConfig(self, key, section='', default=None):
     """Returns the value for the given key from the config in the given section with the given key. Returns default if it does not exist."""
     v = self.__config['project'].Get(key, section, None)
@@ -1558,12 +3720,7 @@ class Env(object):
     if self.__file_dict.has_key(hash_):
       return self.__file_dict[hash_]
 
-    tree = None
-    for t in self.YieldEachInTree():
-      if t.ContainsRel(rel):
-        #NOTE: These are in order of precedence, so existing in multiple trees doesn't matter.
-        tree = t
-        break
+    tree = self.FindInTree(rel)
     if not tree:
       tree = self.__out_tree
 
@@ -1588,7 +3745,7 @@ class Env(object):
           rel_path = t.GetRelPath(path)
           tree = t
           break
-        if os.path.exists(t.GetAbsPath(ath)):
+        if self.__stat_cache.Exists(t.GetAbsPath(ath)):
           rel_path = ath
           tree = t
           break
@@ -1627,6 +3784,16 @@ class Env(object):
           self.__file_dict[hash_] = f
     return f
 
+  def __GetQueueItem(self, item):
+    """Get the File or Job for an item from the processing queue."""
+    if item[0] == 'F':
+      return self.__file_dict[item[1]]
+    elif item[0] == 'J':
+      return self.__job_dict[item[1]]
+    else:
+      #Serious error. Completely invalid type entered.
+      assert(False)
+
   def GetFileKind(self, base, ext_list):
     """Find the best mathcing file_kind for the file. One with the longest prefix on match wins."""
     assert len(ext_list) > 0
@@ -1647,6 +3814,30 @@ class Env(object):
     """Return the list of file kinds which could possibly have the given final extension."""
     return self.__file_kinds_by_ext.get(ext, [])
 
+  def GetArtifactKey(self, kind, command_list, in_file_set):
+    """Get the key the outputs of a job are kept under in the artifact caches.
+
+    The key is a digest of the job kind, the (args, print_command) commands in command_list (with their arguments in
+    order, since that can change what they make), and the contents of every file in in_file_set. Paths in the out tree (and the project root, if artifact_cache_relocate_root is set) are
+    relocated before the commands are hashed, so the same job in another out tree gets the same key. Returns None if one
+    of the files can't be read."""
+    digest = hashlib.sha1()
+    digest.update(kind.name + '\n')
+    for args, print_command in command_list:
+      relocated_args = []
+      for arg in args:
+        for prefix, replacement in self.__relocate_list:
+          arg = arg.replace(prefix, replacement)
+        relocated_args.append(arg)
+      digest.update('\0'.join(relocated_args))
+      digest.update('\n')
+    for f in sorted(in_file_set, key=lambda f: (f.tree.kind, f.rel_path)):
+      file_digest = self.__digests.Get(f.abs_path)
+      if file_digest is None:
+        return None
+      digest.update('%s:%s=%s\n' % (f.tree.kind, f.rel_path, file_digest))
+    return digest.hexdigest()
+
   def GetJob(self, kind, in_file, out_only=False):
     """Gets job from job dict or creates it.
 
@@ -1664,6 +3855,29 @@ class Env(object):
       j.FinishInit()
     return j
 
+  def GetJobDuration(self, job):
+    """Get the estimated number of seconds it will take to run the given job, based on previous builds."""
+    duration = self.__duration_file.Get(self.__GetDurationKey(job), job.kind.name)
+    if duration is None:
+      return self.__kind_duration_dict.get(job.kind.name, 1.0)
+    return float(duration)
+
+  def SetJobDuration(self, job, duration):
+    """Record how many seconds it took to run the given job."""
+    with self.__duration_lock:
+      self.__duration_file.Set(job.kind.name, self.__GetDurationKey(job), '%.3f' % duration)
+      self.__duration_changed = True
+
+  def SaveJobDurations(self):
+    """Write out any job durations recorded during this build."""
+    with self.__duration_lock:
+      if self.__duration_changed:
+        self.__duration_file.Save()
+        self.__duration_changed = False
+
+  def __GetDurationKey(self, job):
+    return min(f.rel_path for f in job.output_set) if job.output_set else ''
+
   def GetSysConfig(self, key, section='', default=None):
     """Get an item from the system config only, not project specific config."""
     v = self.__config['user'].Get(key, section, None)
@@ -1671,11 +3885,11 @@ class Env(object):
       v = self.__config['sys'].Get(key, section, default)
     return v
 
-  def Queue(self, item_set):
-    return self.__queue.AddRequired(item_set)
+  def Queue(self, item_set, block=True):
+    """Queue everything in item_set which isn't done. Returns false if nothing is left to be done.
 
-  def QueueIfNeeded(self, item_set):
-    return self.__queue.AddIfNeeded(item_set)
+    When called with block while building a File or Job, that item won't be retried until all of item_set is done."""
+    return self.__queue.AddRequired(item_set, block)
 
   def SplitRelPath(self, rel_path):
     """Split a relative path into a branch, base, and ext_list"""
@@ -1691,9 +3905,12 @@ class Env(object):
 
   def YieldConfigSection(self, section=''):
     """Yields each k, v pair in the given section for all configurations."""
-
-    for k, v in JHMFile.MergeAndYieldSection([self.__config['project'], self.__config['user'], self.__config['sys']], section):
-      yield k, v
+    #The configs don't change for the life of the Env.
+    items = self.__config_section_dict.get(section)
+    if items is None:
+      items = self.__config_section_dict[section] = list(JHMFile.MergeAndYieldSection(
+          [self.__config['project'], self.__config['user'], self.__config['sys']], section))
+    return iter(items)
 
   def YieldEachInTree(self):
     """Yields each input tree in the env, in order of precedence."""
@@ -1725,11 +3942,31 @@ class Env(object):
     """The machine architecture (x86, x86_64, etc.)"""
     return self.__options.arch
 
+  @property
+  def artifact_cache(self):
+    """The cache of job outputs shared between out trees, or None if there isn't one."""
+    return self.__artifact_cache
+
+  @property
+  def cache_store(self):
+    """Where the caches of Files are kept (A LogCacheStore or FileCacheStore)."""
+    return self.__cache_store
+
+  @property
+  def closure_index(self):
+    """The ClosureIndex link jobs share."""
+    return self.__closure_index
+
   @property
   def config(self):
     """The build configuration to use (release, debug, etc.)"""
     return self.__options.config
 
+  @property
+  def digest_store(self):
+    """The DigestStore used to tell if files have changed, or None if timestamps are used instead."""
+    return self.__digest_store
+
   @property
   def force(self):
     """Whether or not all jobs should be run no matter what."""
@@ -1750,11 +3987,27 @@ class Env(object):
     """The tree to which all output should be written"""
     return self.__out_tree
 
+  @property
+  def restat_store(self):
+    """The DigestStore used to tell if a job made its outputs exactly the same again, or None if they always get a new
+    stamp."""
+    return self.__restat_store
+
+  @property
+  def remote_cache(self):
+    """The cache of job outputs on a server, or None if there isn't one."""
+    return self.__remote_cache
+
   @property
   def root(self):
     """The root directory of the JHM Environment."""
     return self.__root
 
+  @property
+  def stat_cache(self):
+    """The StatCache to use for looking at files in the environment."""
+    return self.__stat_cache
+
   @property
   def src_tree(self):
     """The primary input tree."""
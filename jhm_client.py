@@ -0,0 +1,56 @@
+# This file is licensed under the terms of the Apache License, Version 2.0
+# Please see the file COPYING for the full text of this license
+#
+# Copyright 2010-2011 Tagged
+
+"""Hands runs of jhm scripts to the project's jhm_server, if one is running.
+
+Only imports what it needs to, so that handing off a build is much quicker than loading jhm to do it."""
+
+import json, os, os.path, socket, sys
+
+#The name of the socket jhm_server listens on, in the project root.
+SOCKET_NAME = '.jhm-server'
+
+def FindSocket():
+  """Get the path of the server socket for the project the current directory is in, or None if it isn't in one."""
+  path = os.getcwd()
+  while True:
+    if os.path.exists(os.path.join(path, '.jhm')):
+      return os.path.join(path, SOCKET_NAME)
+    parent = os.path.dirname(path)
+    if parent == path:
+      return None
+    path = parent
+
+def Forward(program, argv):
+  """Have the project's jhm_server run program with argv, printing everything it sends back. Returns False without doing
+  anything if there is no server, or argv asks for something only a build in this process can do (--watch)."""
+  for arg in argv[1:]:
+    if arg in ['--no-server', '--watch'] or (arg.startswith('-') and not arg.startswith('--') and 'w' in arg):
+      return False
+
+  path = FindSocket()
+  if path is None:
+    return False
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except socket.error:
+    sock.close()
+    return False
+
+  try:
+    sock.sendall(json.dumps({'program': program, 'argv': argv, 'cwd': os.getcwd()}) + '\n')
+    sock.shutdown(socket.SHUT_WR)
+    while True:
+      data = sock.recv(65536)
+      if not data:
+        break
+      sys.stdout.write(data)
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sock.close()
+  return True
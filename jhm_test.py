@@ -48,8 +48,7 @@ class Env(jhm.Env):
 
   def __init__(self, options):
     #Basic setup
-    if options.test_verbose:
-      options.exec_targets = True
+    self.__SetupOptions(options)
 
     #Setup that must happen before env init, because env init will touch it.
     self.__implied_targets = []
@@ -57,7 +56,23 @@ class Env(jhm.Env):
     super(Env, self).__init__(options)
     self.__check_inc = options.check_inc if options.check_inc is not None else bool(self.GetConfig('check_inc', section='test', default=False))
     self.__test_ext_list = [options.test_ext if options.test_ext is not None else self.GetConfig('ext', section='test', default='test'), '']
+    self.__AddTests(options)
+
+  def __SetupOptions(self, options):
+    if options.test_verbose:
+      options.exec_targets = True
+    #Implied tests are only found while building the graph of a target, so no target can be skipped.
+    if options.implied_tests:
+      options.no_graph_snapshot = True
+
+  def Retarget(self, options):
+    self.__SetupOptions(options)
+    self.__implied_targets = []
+    super(Env, self).Retarget(options)
+    self.__AddTests(options)
 
+  def __AddTests(self, options):
+    """Find the tests to build and run along with the targets."""
     #Keep track of what was test added vs. non-test to ensure we run non-tests before tests.
     self.__base_targets = self.target_file_set
     self.__test_targets = set()
@@ -159,9 +174,9 @@ class Env(jhm.Env):
         print f
         RunTest([f.abs_path] + (['-v'] if self.options.test_verbose else []))
 
-  def Queue(self, item_set):
+  def Queue(self, item_set, block=True):
     #Queue the items
-    retval = super(Env, self).Queue(frozenset(item_set))
+    retval = super(Env, self).Queue(frozenset(item_set), block)
     #See if there are any  tests for the file, and if so, add them as well
     #TODO: The set(self.__implied_targets could be fairly expensive.
     if self.options.implied_tests:
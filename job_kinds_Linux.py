@@ -4,14 +4,18 @@
 # Copyright 2010-2011 Tagged
 
 from itertools import chain
-import os.path
+import collections, os.path, threading
 
 from jhm import BuildError, JobKind
-from file_kinds import BuildGccEnv, BuildHaskellEnv, GetConfigSectionAsArgs
+from file_kinds import BuildGccEnv, BuildHaskellEnv, GetConfigSectionAsArgs, GetIncludeScanner, ParseMakeDeps
 import haskell
 
 haskell_deps = haskell.Deps()
 
+def SortByPath(file_set):
+  """Get the files in file_set in a stable order, so the commands made from them are the same every build."""
+  return sorted(file_set, key=lambda f: f.abs_path)
+
 def SetGnuArg(jhm_cache_file, arg):
   jhm_cache_file.Set('g++-args',arg)
   jhm_cache_file.Set('gcc-args',arg)
@@ -39,7 +43,7 @@ class CompileC(JobKind):
     self.__is_cpp = is_cpp
     self.__is_pic = is_pic
     self.__out_ext = 'o_pic' if is_pic else 'o'
-    JobKind.__init__(self, 'compile C' + ('++' if is_cpp else '') + (' PIC' if is_pic else ''), ext, [self.__out_ext])
+    JobKind.__init__(self, 'compile C' + ('++' if is_cpp else '') + (' PIC' if is_pic else ''), ext, [self.__out_ext], {'memory': '256M'})
 
   #Compilation has no actual depends. (just the input files have reqs from scanning).
   def GetDepends(self, req_set):
@@ -63,10 +67,29 @@ class CompileC(JobKind):
     args.append('-o' + j.env.out_tree.GetAbsPath(list(j.output_set)[0].rel_path))
     args.append('-DSRC_ROOT="%s"' % j.env.src_tree.path)
 
+    #Have the compile write out what it included, rather than preprocessing the source separately to find out.
+    if GetIncludeScanner(j.input) == 'depfile':
+      args += ['-MD', '-MF', self.__GetDepfile(j)]
+
     def Go():
       j.env.RunBuildCmd(args)
     return Go
 
+  def Finish(self, j):
+    depfile = self.__GetDepfile(j)
+    if GetIncludeScanner(j.input) != 'depfile' or not os.path.exists(depfile):
+      return
+    with open(depfile) as f:
+      path_list = ParseMakeDeps(f.read())
+    os.remove(depfile)
+    j.output.AddReqs(set(j.env.GetFileFromPath(path) for path in path_list))
+
+  def IsCacheable(self, j):
+    return GetIncludeScanner(j.input) != 'depfile'
+
+  def __GetDepfile(self, j):
+    return j.output.abs_path + '.d'
+
 class GenerateSwig(JobKind):
 
   def __init__(self, wrapper, cpp):
@@ -115,10 +138,55 @@ class GenerateSwig(JobKind):
       j.env.RunBuildCmd(args)
     return Go
 
+class GhcMakeBatcher(object):
+  """Compiles Haskell modules with ghc --make, a batch at a time. Every module submitted while a batch is compiling goes
+  in the next one, so modules which are ready at the same time share one ghc (which compiles them in parallel). Only one
+  batch runs at once, since ghc --make also compiles what the modules import, and two would write the same outputs."""
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__running = False
+    self.__pending_dict = collections.OrderedDict()  #Args -> list of (job, path, on_success) waiting to be compiled
+
+  def Submit(self, job, args, path, on_success):
+    """Compile the module at path with ghc args (Without the modules to compile), as part of the given job. Once its
+    batch has, on_success is called with the seconds the batch took, and the job is finished like Env.RunDeferred does."""
+    with self.__lock:
+      self.__pending_dict.setdefault(tuple(args), []).append((job, path, on_success))
+      start = not self.__running
+      self.__running = True
+    if start:
+      self.__RunNext(job.env)
+
+  def __RunNext(self, env):
+    """Start the batch of the modules which have been waiting longest, if any are."""
+    with self.__lock:
+      if not self.__pending_dict:
+        self.__running = False
+        return
+      key, batch = self.__pending_dict.popitem(last=False)
+
+    def Finished(elapsed, exc_info):
+      for job, path, on_success in batch:
+        if exc_info:
+          env.FinishDeferred(job, exc_info)
+        else:
+          env.ResumeDeferred(job, on_success, elapsed)
+      self.__RunNext(env)
+
+    env.SubmitCmd(list(key) + sorted(set(path for job, path, on_success in batch)), env.options.print_build_cmd, Finished)
+
+ghc_make_batcher = GhcMakeBatcher()
+
+def GetHaskellCompile(f):
+  """Get how the Haskell source f is compiled: 'module' (on its own, always recompiled), or 'make' (in batches with ghc
+  --make, which skips modules whose imports' interfaces didn't change)."""
+  return f.GetConfig('haskell_compile', result=f.env.GetConfig('haskell_compile', default='module'))
+
 class Haskell(JobKind):
   def __init__(self, pic):
     self.__pic = pic
-    JobKind.__init__(self, 'compile haskell', 'hs', ['hi_pic','o_pic'] if pic else ['hi', 'o'])
+    JobKind.__init__(self, 'compile haskell', 'hs', ['hi_pic','o_pic'] if pic else ['hi', 'o'], {'haskell': 1, 'memory': '1G'})
 
   def GetInput(self, out_f):
     return out_f.GetRelatedFileAndTree(ext_list=out_f.ext_list[:-1] + ['hs'])
@@ -143,17 +211,44 @@ class Haskell(JobKind):
         ])
 
   def GetRunner(self, j):
+    pic_args = ['-fPIC','-hisuf','hi_pic','-osuf','o_pic','-dynamic'] if self.__pic else []
+    if self.__IsBatched(j):
+      #-outputdir puts the .o and .hi of each module where its job would. The command is what compiling just this module
+      #with ghc --make would be. RunCommands compiles it in a batch instead.
+      args = BuildHaskellEnv(j.input) + ['--make', '-no-link', '-j'] + pic_args + [j.input.abs_path]
+      def Go():
+        self.__SetLinkArgs(j)
+        j.env.RunBuildCmd(args)
+      return Go
+
     obj_out = filter(lambda f: f.ext_list[-1] == ('o_pic' if self.__pic else 'o'), j.output_set)[0]
-    args = BuildHaskellEnv(j.input) + ['-c',j.input.abs_path,'-fforce-recomp','-o', obj_out.abs_path]
-    if self.__pic:
-      args += ['-fPIC','-hisuf','hi_pic','-osuf','o_pic','-dynamic']
+    args = BuildHaskellEnv(j.input) + ['-c',j.input.abs_path,'-fforce-recomp','-o', obj_out.abs_path] + pic_args
     def Go():
-      for f in j.output_set:
-        if f.ext_list[-1] == 'o_pic':
-          f.jhm_cache_file.Set('link-args','-Bsymbolic')
+      self.__SetLinkArgs(j)
       j.env.RunBuildCmd(args)
     return Go
 
+  def RunCommands(self, j, command_list, on_success):
+    if not self.__IsBatched(j):
+      JobKind.RunCommands(self, j, command_list, on_success)
+      return
+    [(args, print_command)] = command_list
+    ghc_make_batcher.Submit(j, args[:-1], args[-1], on_success)
+
+  def IsCacheable(self, j):
+    #What a batch compiles (and reads) isn't known up front.
+    return not self.__IsBatched(j)
+
+  def __IsBatched(self, j):
+    #ghc --make puts the object of a Main module in <outputdir>/Main.o, rather than where its job would, and can't
+    #compile two Main modules at once, so they're compiled on their own.
+    return GetHaskellCompile(j.input) == 'make' and not any(k == 'main' for k, v in j.input.YieldSection('haskell'))
+
+  def __SetLinkArgs(self, j):
+    for f in j.output_set:
+      if f.ext_list[-1] == 'o_pic':
+        f.jhm_cache_file.Set('link-args','-Bsymbolic')
+
 #TODO: Come up with a non-hand-coded way to do this...
 link_map = {
   'boost/regex.hpp': '-lboost_regex',
@@ -173,27 +268,37 @@ link_map = {
   'xcb/xcb.h': '-lxcb',
 }
 
+def GetLinkFlags(f):
+  """Get what f adds to links it's in: the haskell modules it imports, whether it's a haskell main, and what to link
+  for it from link_map (or None)."""
+  hs_deps = frozenset(l[0] for l in f.YieldSection('haskell-deps'))
+  hs_main = any(k == 'main' for k, v in f.YieldSection('haskell'))
+  return hs_deps, hs_main, link_map.get(f.rel_path)
+
 class Link(JobKind):
-  def __init__(self, is_pic=False, name='link', out_ext=['']):
+  def __init__(self, is_pic=False, name='link', out_ext=[''], resources={'link': 1, 'memory': '2G'}):
     self.__in_ext = 'o_pic' if is_pic else 'o'
     self.__out_ext = out_ext[0]
-    JobKind.__init__(self, name + (' PIC' if is_pic else ''), self.__in_ext, out_ext)
+    JobKind.__init__(self, name + (' PIC' if is_pic else ''), self.__in_ext, out_ext, resources)
 
   def GetDepends(self, req_set):
     #TODO: Add haskell dependencies.
-    #TODO: Simplify this.?
+    if not req_set:
+      return set()
+    #The reqs of each file are already in req_set (req_sets hold everything required indirectly), so only the reqs of
+    #objects found along the way need to be followed.
+    index = iter(req_set).next().env.closure_index
     dep_set = set()
     to_check = list(req_set)
     full_set = set(req_set)
     while to_check:
       f = to_check.pop()
-      to_check += list(f.req_set - full_set)
-      full_set |= f.req_set
-      dep = f.GetRelatedFileAndTree(ext_list=f.ext_list[:-1] + [self.__in_ext])
-      if dep and dep.is_available:
-        to_check += list((dep_set | set([dep]) | dep.req_set) - full_set)
-        full_set |= dep_set | set([dep]) | dep.req_set
+      dep = index.GetSibling(f, self.__in_ext)
+      if dep is not None and dep not in dep_set:
         dep_set.add(dep)
+        new_set = (dep.req_set | set([dep])) - full_set
+        to_check += new_set
+        full_set |= new_set
     return dep_set
 
   def GetInput(self, out_file):
@@ -210,38 +315,36 @@ class Link(JobKind):
     use_hs_main = False
 
     #Collect haskell deps from tree.
-    for f in j.depend_set:
+    for f in SortByPath(j.depend_set):
       args.append(f.abs_path)
 
-    dep_set = set()
-    to_check = list(j.depend_set)
-    to_check.append(j.input)
-    full_set = j.depend_set
-    while to_check:
-      f = to_check.pop()
-      to_check += list(f.req_set - full_set)
-      full_set |= f.req_set
-      dep_set |= set(map(lambda l: l[0], chain(f.YieldParentSection('haskell-deps'), f.YieldReqSection('haskell-deps'), f.YieldSection('haskell-deps'))))
-      use_hs_main |= f.HasInConfig('haskell', 'main')
+    #What each file adds to the link is worked out once, and shared with every other link it's in.
+    index = j.env.closure_index
+    dep_set = set(l[0] for l in j.input.YieldParentSection('haskell-deps'))
+    link_list = []
+    for f in SortByPath(index.GetClosure(j.depend_set | set([j.input]))):
+      hs_deps, hs_main, link_lib = index.Get(f, 'link', GetLinkFlags)
+      dep_set |= hs_deps
+      use_hs_main |= hs_main
+      if link_lib is not None:
+        link_list.append(link_lib)
 
     if use_hs_main:
       args.append('-lHSrtsmain')
 
     if self.__out_ext in ['','a']:
-      new_args = haskell_deps.GetStaticLinkArgs(dep_set)
+      new_args = haskell_deps.GetStaticLinkArgs(sorted(dep_set))
       args += new_args
     elif self.__out_ext in ['so']:
-      args += haskell_deps.GetDynamicLinkArgs(dep_set)
+      args += haskell_deps.GetDynamicLinkArgs(sorted(dep_set))
 
     #Lookup dependencies which need to be linked against.
-    for dep in set(chain(j.input.req_set, reduce(lambda x, y: x | y, map(lambda d: d.req_set, j.depend_set),set()))):
-      link_lib = link_map.get(dep.rel_path,None)
-      if link_lib is not None:
-        if isinstance(link_lib, str):
-          args.append(link_lib)
-        else:
-          assert isinstance(link_lib, list)
-          args += link_lib
+    for link_lib in link_list:
+      if isinstance(link_lib, str):
+        args.append(link_lib)
+      else:
+        assert isinstance(link_lib, list)
+        args += link_lib
 
 
     args += GetConfigSectionAsArgs(j.input, 'link-args')
@@ -257,12 +360,12 @@ class Link(JobKind):
 
 class Archive(Link):
   def __init__(self):
-    Link.__init__(self, True, 'archive', ['a'])
+    Link.__init__(self, True, 'archive', ['a'], {})
 
   def GetRunner(self, j):
     #TODO: Add config section 'link args'?
     #TODO: This one is massively wrong...
-    args = ['ar', 'rcs', j.output.abs_path] + [f.abs_path for f in j.depend_set]
+    args = ['ar', 'rcs', j.output.abs_path] + [f.abs_path for f in SortByPath(j.depend_set)]
     args += GetConfigSectionAsArgs(j.input, 'archive-args')
     def Go():
       j.env.RunBuildCmd(args)
@@ -377,7 +480,7 @@ class TranslateYacc(JobKind):
 
   def GetRunner(self, job):
     args = ['bison-fixer.py', job.input.name]
-    for f in job.depend_set:
+    for f in SortByPath(job.depend_set):
       args.append(f.abs_path)
     args.append(job.output_dir)
 